@@ -0,0 +1,72 @@
+"""
+Write latency of POST /movies/{movie_id}/conversations/ by conversation size.
+
+Compares the previous write path (three validation queries and one INSERT per
+line) with create_conversation (one validation lookup and one multi-row insert).
+Everything runs inside a transaction that is rolled back, so the database is
+left as it was apart from skipped sequence values.
+
+    python -m benchmarks.bench_add_conversation [--movie 0 --c1 0 --c2 2 --repeat 5]
+"""
+import argparse
+import statistics
+import time
+from sqlalchemy import text
+from src import database as db
+from src.api.conversations import ConversationJson, LinesJson, create_conversation, update_line_counts
+
+
+def legacy_create_conversation(conn, movie_id: int, conversation: ConversationJson) -> int:
+    # the write path before the bulk insert, kept here as the baseline
+    if conn.execute(text("SELECT * FROM movies WHERE movie_id = :id"), {"id": movie_id}).fetchone() is None:
+        raise ValueError("movie not found.")
+    for c in (conversation.character_1_id, conversation.character_2_id):
+        if conn.execute(text("SELECT * FROM characters WHERE character_id = :id AND movie_id = :movie_id"), {"id": c, "movie_id": movie_id}).fetchone() is None:
+            raise ValueError("characters not in movie.")
+
+    convo_id = conn.execute(db.conversations.insert().values(character1_id=conversation.character_1_id, character2_id=conversation.character_2_id, movie_id=movie_id).returning(db.conversations.c.conversation_id)).scalar_one()
+    for s, line in enumerate(conversation.lines):
+        conn.execute(db.lines.insert().values(character_id=line.character_id, movie_id=movie_id, conversation_id=convo_id, line_sort=s, line_text=line.line_text))
+    update_line_counts(conn, [(convo_id, conversation)])
+    return convo_id
+
+
+def make_conversation(c1: int, c2: int, n: int) -> ConversationJson:
+    return ConversationJson(
+        character_1_id=c1,
+        character_2_id=c2,
+        lines=[LinesJson(character_id=c1 if i % 2 == 0 else c2, line_text=f"benchmark line {i}") for i in range(n)],
+    )
+
+
+def time_write(fn, movie_id: int, conversation: ConversationJson, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        with db.engine.connect() as conn:
+            trans = conn.begin()
+            start = time.perf_counter()
+            fn(conn, movie_id, conversation)
+            timings.append(time.perf_counter() - start)
+            trans.rollback()
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--movie", type=int, default=0)
+    parser.add_argument("--c1", type=int, default=0)
+    parser.add_argument("--c2", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f"{'lines':>6} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>8}")
+    for n in args.sizes:
+        conversation = make_conversation(args.c1, args.c2, n)
+        before = time_write(legacy_create_conversation, args.movie, conversation, args.repeat)
+        after = time_write(create_conversation, args.movie, conversation, args.repeat)
+        print(f"{n:>6} {before:>12.1f} {after:>12.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Read throughput of the API with the blocking engine (DB_ASYNC=0, handlers run
+their queries in the threadpool) against the asyncpg engine (DB_ASYNC=1).
+
+Each mode starts its own uvicorn worker and gets the same mix of read requests
+from --concurrency simultaneous clients. The response cache is sized to zero so
+every request reaches the database.
+
+    python -m benchmarks.bench_async [--concurrency 200 --requests 4000 --port 8765]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+PATHS = [
+    "/movies/?limit=50",
+    "/movies/?sort=rating&limit=50",
+    "/characters/?limit=50",
+    "/characters/?sort=number_of_lines&limit=50",
+    "/lines/conversations/?limit=50",
+    "/movies/0",
+    "/characters/0",
+    "/lines/0",
+]
+
+
+def start_server(port: int, async_mode: bool) -> subprocess.Popen:
+    env = dict(os.environ, DB_ASYNC="1" if async_mode else "0", CACHE_BACKEND="memory", CACHE_MAXSIZE="0")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.api.server:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def load(base_url: str, concurrency: int, total: int) -> dict:
+    timings = []
+    errors = 0
+    queue = iter(range(total))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await wait_ready(client)
+
+        async def worker():
+            nonlocal errors
+            for i in queue:
+                start = time.perf_counter()
+                response = await client.get(PATHS[i % len(PATHS)])
+                timings.append(time.perf_counter() - start)
+                # every path exists, anything but a 2xx means the numbers are off
+                if not 200 <= response.status_code < 300:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    timings.sort()
+    return {
+        "rps": total / elapsed,
+        "p50": statistics.median(timings) * 1000,
+        "p95": timings[int(len(timings) * 0.95) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'errors':>7}")
+    for name, async_mode in (("sync", False), ("async", True)):
+        server = start_server(args.port, async_mode)
+        try:
+            result = asyncio.run(load(f"http://127.0.0.1:{args.port}", args.concurrency, args.requests))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{name:>6} {result['rps']:>8.0f} {result['p50']:>9.1f} {result['p95']:>9.1f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
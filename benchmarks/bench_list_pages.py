@@ -0,0 +1,73 @@
+"""
+Latency of the list endpoints by page depth: the SQL path (ORDER BY ... LIMIT
+OFFSET) against the presorted views of the snapshot engine.
+
+Every sort option of /characters/ and /lines/conversations/ is timed at a few
+offsets, with and without a filter.
+
+    python -m benchmarks.bench_list_pages [--limit 50 --repeat 20]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from fastapi import Response
+from src import database as db
+from src import snapshot
+from src.api import characters, lines
+
+DEPTHS = [0, 1000, 10000, 30000]
+
+
+def median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with db.engine.connect() as conn:
+        snap = snapshot.Snapshot.load(conn)
+
+    # the sql side goes through the real handlers with the cache and snapshot off
+    snapshot.enabled = lambda: False
+    characters.cache.response_cache.maxsize = 0
+
+    cases = []
+    for sort in ("character", "movie", "number_of_lines"):
+        for name in ("", "an"):
+            cases.append((
+                f"characters sort={sort} name={name!r}",
+                lambda offset, sort=sort, name=name: asyncio.run(characters.list_characters(Response(), name=name, limit=args.limit, offset=offset, sort=sort, cursor=None)),
+                lambda offset, sort=sort, name=name: snap.list_characters(name, sort, args.limit, offset),
+                len(snap.character_views[sort].rows),
+            ))
+    for sort in ("conversation_id", "title", "line_count"):
+        for count in (None, 5):
+            cases.append((
+                f"conversations sort={sort} count={count}",
+                lambda offset, sort=sort, count=count: asyncio.run(lines.list_conversations(Response(), count=count, limit=args.limit, offset=offset, sort=sort, cursor=None)),
+                lambda offset, sort=sort, count=count: snap.list_conversations(count, sort, args.limit, offset),
+                len(snap.convo_views[sort].rows),
+            ))
+
+    print(f"{'query':<44} {'offset':>7} {'sql (ms)':>9} {'snapshot (ms)':>14} {'speedup':>8}")
+    for name, sql, memory, size in cases:
+        for offset in DEPTHS:
+            if offset >= size:
+                continue
+            before = median_ms(lambda: sql(offset), args.repeat)
+            after = median_ms(lambda: memory(offset), args.repeat)
+            print(f"{name:<44} {offset:>7} {before:>9.2f} {after:>14.3f} {before / after:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Memory and lookup latency of the snapshot read engine (src/snapshot.py).
+
+Memory is measured with tracemalloc while loading the same rows into the
+snapshot and into the old model from database.py, one Python object per row
+in dicts. Lookups compare get_movie, get_character and get_lines served from
+the snapshot against the SQL the routers run otherwise.
+
+    python -m benchmarks.bench_snapshot [--samples 200]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import tracemalloc
+from sqlalchemy import text
+from src import database as db
+from src import snapshot
+from src.api import characters, lines, movies
+
+
+class Row:
+    # the old model, a plain object per row
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def load_objects(conn) -> dict:
+    model = {}
+    for table, key in (("movies", "movie_id"), ("characters", "character_id"), ("conversations", "conversation_id"), ("lines", "line_id")):
+        model[table] = {row[key]: Row(**row) for row in conn.execute(text(f"SELECT * FROM {table}")).mappings()}
+    return model
+
+
+def traced(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def median_ms(fn, ids) -> float:
+    timings = []
+    for id in ids:
+        start = time.perf_counter()
+        fn(id)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    with db.engine.connect() as conn:
+        _, objects_size, _ = traced(lambda: load_objects(conn))
+        snap, snapshot_size, load_time = traced(lambda: snapshot.Snapshot.load(conn))
+
+    print(f"{'model':<16} {'memory (MB)':>12}")
+    print(f"{'dict of objects':<16} {objects_size / 1e6:>12.1f}")
+    print(f"{'snapshot':<16} {snapshot_size / 1e6:>12.1f}   (loaded in {load_time:.1f} s)")
+    print()
+
+    # the sql side goes through the real handlers with the cache and snapshot off
+    snapshot.enabled = lambda: False
+    movies.cache.response_cache.maxsize = 0
+
+    def sql(handler):
+        return lambda id: asyncio.run(handler(id))
+
+    random.seed(0)
+    cases = [
+        ("get_movie", snap.get_movie, sql(movies.get_movie), random.sample(list(snap.movie_ids), min(args.samples, len(snap.movie_ids)))),
+        ("get_character", snap.get_character, sql(characters.get_character), random.sample(list(snap.character_ids), args.samples)),
+        ("get_lines", snap.get_lines, sql(lines.get_lines), random.sample(list(snap.convo_ids), args.samples)),
+    ]
+    print(f"{'lookup':<14} {'sql (ms)':>9} {'snapshot (ms)':>14} {'speedup':>8}")
+    for name, fast, slow, ids in cases:
+        before = median_ms(slow, ids)
+        after = median_ms(fast, ids)
+        print(f"{name:<14} {before:>9.3f} {after:>14.4f} {before / after:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
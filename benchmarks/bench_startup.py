@@ -0,0 +1,96 @@
+"""
+Cold start cost of the app: time to import src.api.server in a fresh
+interpreter, measured with `python -X importtime`.
+
+Reports the median over --repeat runs, the slowest modules imported along the
+way and any module from DEFERRED that got imported at startup (those should
+only load on first use). The result is compared with the committed baseline in
+benchmarks/startup_baseline.json, the process exits non zero when the import
+got more than --max-regression slower or a deferred module shows up.
+
+    python -m benchmarks.bench_startup [--repeat 7 --top 10 --save]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "startup_baseline.json")
+
+# only needed once a request actually reaches the database or the debug endpoints
+DEFERRED = ["supabase", "pkg_resources", "dotenv", "psycopg2", "asyncpg", "sqlalchemy.ext.asyncio"]
+
+
+def import_times() -> dict:
+    """
+    module -> cumulative import time in microseconds, for one fresh import of
+    the server.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import src.api.server"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure(repeat: int) -> dict:
+    runs = [import_times() for _ in range(repeat)]
+    modules = {name: statistics.median(run.get(name, 0) for run in runs) / 1000 for name in runs[0]}
+    return {
+        "total_ms": modules["src.api.server"],
+        "modules": modules,
+        "deferred_imported": [name for name in DEFERRED if name in modules],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--save", action="store_true", help="write the result as the new baseline")
+    args = parser.parse_args()
+
+    result = measure(args.repeat)
+
+    print(f"import src.api.server: {result['total_ms']:.1f} ms (median of {args.repeat})")
+    print(f"{'module':<40} {'cumulative (ms)':>16}")
+    top = sorted(result["modules"].items(), key=lambda item: item[1], reverse=True)
+    for name, ms in top[1:args.top + 1]:
+        print(f"{name:<40} {ms:>16.1f}")
+
+    if args.save:
+        with open(BASELINE, "w") as f:
+            json.dump({"total_ms": round(result["total_ms"], 1), "deferred_imported": result["deferred_imported"]}, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {BASELINE}")
+        return
+
+    failed = False
+    if result["deferred_imported"]:
+        print(f"imported at startup but should be deferred: {', '.join(result['deferred_imported'])}")
+        failed = True
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+        change = result["total_ms"] / baseline["total_ms"] - 1
+        print(f"baseline: {baseline['total_ms']:.1f} ms ({change:+.0%})")
+        if change > args.max_regression:
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
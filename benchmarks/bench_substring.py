@@ -0,0 +1,82 @@
+"""
+Latency of the name filters of /movies/ and /characters/ on short, common
+fragments, with and without a substring index.
+
+The indexed side is what the routers run: ILIKE served by the pg_trgm indexes
+from migrations/003_trigram_indexes.sql on Postgres, an id list from the
+in-process n-gram index (src/ngram.py) elsewhere. The scan side is a plain
+ILIKE with the index out of the picture (bitmap scans off on Postgres). The
+snapshot column is the same filter served by the snapshot engine.
+
+    python -m benchmarks.bench_substring [--fragments d man ...] [--repeat 20]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from fastapi import Response
+from src import database as db
+from src import ngram
+from src import snapshot
+from src.api import characters, movies
+
+# from the test fixtures
+FRAGMENTS = ["d", "man", "an", "big", "bianca"]
+
+
+def median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fragments", nargs="+", default=FRAGMENTS)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with db.engine.connect() as conn:
+        snap = snapshot.Snapshot.load(conn)
+
+    # the sql side goes through the real handlers with the cache and snapshot off
+    snapshot.enabled = lambda: False
+    movies.cache.response_cache.maxsize = 0
+
+    indexed_contains, indexed_run = ngram.contains, db.run
+
+    async def scan_contains(id_column, column, fragment):
+        return column.ilike(f"%{fragment}%")
+
+    async def scan_run(fn, *args, **kwargs):
+        def without_index(conn, *args):
+            if conn.dialect.name == "postgresql":
+                conn.exec_driver_sql("SET LOCAL enable_bitmapscan = off")
+            return fn(conn, *args)
+        return await indexed_run(without_index, *args, **kwargs)
+
+    def timed(call, scan: bool):
+        ngram.contains, db.run = (scan_contains, scan_run) if scan else (indexed_contains, indexed_run)
+        return median_ms(lambda: asyncio.run(call()), args.repeat)
+
+    print(f"{'query':<36} {'matches':>8} {'scan (ms)':>10} {'indexed (ms)':>13} {'speedup':>8} {'snapshot (ms)':>14}")
+    for fragment in args.fragments:
+        cases = [
+            ("movies", lambda: movies.list_movies(Response(), name=fragment, limit=args.limit, offset=0, sort="movie_title", cursor=None), None),
+            ("characters", lambda: characters.list_characters(Response(), name=fragment, limit=args.limit, offset=0, sort="number_of_lines", cursor=None),
+                lambda: snap.list_characters(fragment, "number_of_lines", args.limit)),
+        ]
+        for name, call, memory in cases:
+            matches = len(ngram.NgramIndex(enumerate(snap.movie_title if name == "movies" else snap.character_name)).search(fragment))
+            before = timed(call, scan=True)
+            after = timed(call, scan=False)
+            in_memory = f"{median_ms(memory, args.repeat):>14.3f}" if memory else f"{'-':>14}"
+            print(f"{name + ' name=' + repr(fragment):<36} {matches:>8} {before:>10.2f} {after:>13.2f} {before / after:>7.1f}x {in_memory}")
+
+
+if __name__ == "__main__":
+    main()
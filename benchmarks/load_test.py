@@ -0,0 +1,273 @@
+"""
+Load test of the main endpoints over HTTP: throughput and latency
+percentiles per endpoint, saved as json so runs can be compared across
+commits.
+
+Each endpoint is driven on its own for --duration seconds by --concurrency
+clients, each sending its next request as soon as the last one returned.
+Parameters are drawn from a realistic mix: ids and names sampled from the
+database, every sort order, shallow and deep offsets, and the cases from the
+test fixtures (e.g. offset=3547). The conversation POST writes to the
+database, so only point this at a benchmark database (benchmarks/seed.py).
+
+By default a server is started for the run (uvicorn, --workers) against the
+database the environment points at, with the response cache off so the
+numbers are about the queries. --url tests a server that is already
+running instead, --cache keeps the cache on.
+
+    python -m benchmarks.load_test run [--duration 10 --concurrency 8] [--out base.json]
+    python -m benchmarks.load_test run --ref main --out main.json   # another commit, from a git worktree
+    python -m benchmarks.load_test compare main.json base.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import sqlalchemy
+from src import database as db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIXTURE_NAMES = ["BIANCA", "KEN", "FERRARI", "bianca", "apoc", "imam"]
+
+
+class Sample:
+    """
+    Ids and names to build requests from, read from the database once.
+    """
+
+    def __init__(self, conn, size: int = 1000):
+        self.character_ids = conn.execute(sqlalchemy.text("SELECT character_id FROM characters ORDER BY random() LIMIT :n"), {"n": size}).scalars().all()
+        self.names = [name for name in conn.execute(sqlalchemy.text("SELECT name FROM characters WHERE name IS NOT NULL ORDER BY random() LIMIT :n"), {"n": size}).scalars()] + FIXTURE_NAMES
+        # movies with two or more characters, to post conversations to
+        self.casts = {}
+        for movie_id, character_id in conn.execute(sqlalchemy.text("SELECT movie_id, character_id FROM characters WHERE movie_id IN (SELECT movie_id FROM movies ORDER BY random() LIMIT :n)"), {"n": size}):
+            self.casts.setdefault(movie_id, []).append(character_id)
+        self.casts = [(movie_id, cast) for movie_id, cast in self.casts.items() if len(cast) >= 2]
+
+
+def list_movies(rng, sample):
+    if rng.random() < 0.2:
+        return "GET", rng.choice(["/movies/?limit=50&sort=rating", "/movies/?limit=50&offset=50&sort=rating", "/movies/?name=man&limit=5&offset=0&sort=movie_title", "/movies/?name=big&limit=50&offset=0&sort=rating"]), None
+    params = {
+        "name": rng.choice(["", "", "", "the", "man", "d", "star", "love"]),
+        "sort": rng.choice(["movie_title", "year", "rating"]),
+        "limit": rng.choice([10, 50]),
+        "offset": rng.choice([0, 0, 0, 50, 250]),
+    }
+    return "GET", "/movies/?" + "&".join(f"{k}={v}" for k, v in params.items()), None
+
+
+def get_character(rng, sample):
+    return "GET", f"/characters/{rng.choice(sample.character_ids)}", None
+
+
+def get_character_convos(rng, sample):
+    return "GET", f"/lines/names/{rng.choice(sample.names)}", None
+
+
+def list_conversations(rng, sample):
+    if rng.random() < 0.2:
+        return "GET", rng.choice(["/lines/conversations/?count=25&limit=15&sort=line_count", "/lines/conversations/?count=0&offset=3547&limit=25&sort=conversation_id", "/lines/conversations/?count=0&offset=3522&limit=25&sort=conversation_id"]), None
+    params = {
+        "sort": rng.choice(["conversation_id", "title", "line_count"]),
+        "limit": rng.choice([15, 25, 50]),
+        "offset": rng.choice([0, 0, 100, 3547, 30000]),
+    }
+    count = rng.choice([None, None, 5, 25])
+    if count is not None:
+        params["count"] = count
+    return "GET", "/lines/conversations/?" + "&".join(f"{k}={v}" for k, v in params.items()), None
+
+
+def add_conversation(rng, sample):
+    movie_id, cast = rng.choice(sample.casts)
+    character_1_id, character_2_id = rng.sample(cast, 2)
+    body = {
+        "character_1_id": character_1_id,
+        "character_2_id": character_2_id,
+        "lines": [{"character_id": (character_1_id, character_2_id)[i % 2], "line_text": "benchmark line"} for i in range(rng.randint(2, 8))],
+    }
+    return "POST", f"/movies/{movie_id}/conversations/", body
+
+
+ENDPOINTS = {
+    "GET /movies/": list_movies,
+    "GET /characters/{id}": get_character,
+    "GET /lines/names/{name}": get_character_convos,
+    "GET /lines/conversations/": list_conversations,
+    "POST /movies/{id}/conversations/": add_conversation,
+}
+
+
+async def drive(url: str, request, sample, duration: float, concurrency: int, seed: int) -> dict:
+    latencies = []
+    errors = 0
+
+    async def client(rng):
+        nonlocal errors
+        async with httpx.AsyncClient(base_url=url, timeout=30) as http:
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                method, path, body = request(rng, sample)
+                start = time.perf_counter()
+                try:
+                    response = await http.request(method, path, json=body)
+                    # a 404 for a name nobody has is a normal answer
+                    ok = response.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(random.Random(seed + i)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed)
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0] if latencies else 0.0] * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+    }
+
+
+def git_rev(ref: str = "HEAD") -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", ref], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def start_server(cwd: str, port: int, workers: int, cache: bool):
+    env = dict(os.environ)
+    if not cache:
+        env["CACHE_MAXSIZE"] = "0"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.api.server:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=cwd, env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("the server exited during startup")
+        try:
+            if httpx.get(url + "/", timeout=1).status_code == 200:
+                return server, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("the server didn't come up within 60 s")
+
+
+def run(args):
+    cwd = ROOT
+    worktree = None
+    if args.ref is not None:
+        worktree = tempfile.mkdtemp(prefix="bench-")
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, args.ref], cwd=ROOT, check=True, capture_output=True)
+        cwd = worktree
+
+    with db.engine.connect() as conn:
+        sample = Sample(conn)
+
+    server = None
+    try:
+        if args.url is None:
+            server, url = start_server(cwd, args.port, args.workers, args.cache)
+        else:
+            url = args.url
+
+        endpoints = {name: request for name, request in ENDPOINTS.items() if not args.endpoints or any(e in name for e in args.endpoints)}
+        results = {}
+        print(f"{'endpoint':<34} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+        for name, request in endpoints.items():
+            if args.warmup > 0:
+                asyncio.run(drive(url, request, sample, args.warmup, args.concurrency, args.seed))
+            result = asyncio.run(drive(url, request, sample, args.duration, args.concurrency, args.seed))
+            results[name] = result
+            print(f"{name:<34} {result['requests']:>9} {result['errors']:>7} {result['rps']:>8.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if worktree is not None:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=ROOT, capture_output=True)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    if args.out is not None:
+        report = {
+            "commit": git_rev(args.ref or "HEAD"),
+            "backend": db.backend(),
+            "settings": {"duration": args.duration, "concurrency": args.concurrency, "workers": args.workers, "cache": args.cache},
+            "endpoints": results,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+def compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def change(before, after):
+        return f"{(after - before) / before * 100:+.0f}%" if before else "-"
+
+    print(f"{base['commit']} -> {new['commit']}")
+    print(f"{'endpoint':<34} {'req/s':>17} {'p50 (ms)':>17} {'p95 (ms)':>17} {'p99 (ms)':>17}")
+    for name, after in new["endpoints"].items():
+        before = base["endpoints"].get(name)
+        if before is None:
+            continue
+        cells = [f"{after[key]:>9.1f} {change(before[key], after[key]):>7}" for key in ("rps", "p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<34} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--url", default=None, help="server to test, one is started otherwise")
+    run_parser.add_argument("--ref", default=None, help="start the server from this commit (a temporary git worktree)")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--cache", action="store_true", help="keep the response cache on")
+    run_parser.add_argument("--duration", type=float, default=10)
+    run_parser.add_argument("--warmup", type=float, default=2)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--endpoints", nargs="*", help="only endpoints containing one of these")
+    run_parser.add_argument("--out", default=None, help="write the results here as json")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
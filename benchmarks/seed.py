@@ -0,0 +1,164 @@
+"""
+Seeds a database for the benchmark suite from the bundled csvs, optionally
+scaled up. --scale 10 loads ten copies of every table with the ids of each
+copy shifted past the previous one, so a 10x or 100x database keeps the shape
+of the real one: same names, same conversations per character, same lines
+per conversation, just more of everything.
+
+The lines file isn't shipped with the repo. Without --lines, 2 to 12 lines
+are made up per conversation, alternating between its two characters, from a
+fixed seed so every run produces the same database.
+
+It seeds whatever the app is configured for: the POSTGRES_* database (e.g.
+the one from benchmarks/docker-compose.yml) or SQLITE_PATH with
+DB_BACKEND=sqlite. A database that already has the tables is only replaced
+with --reset. Indexes and aggregates come from the regular migrations, run
+once the rows are in.
+
+    python -m benchmarks.seed [--scale 10] [--lines lines.csv] [--reset]
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import time
+import sqlalchemy
+from src import database as db
+from src import migrate
+from src import sqlite_db
+
+# the columns holding ids, and the table each id belongs to
+ID_COLUMNS = {
+    "movies": {"movie_id": "movies"},
+    "characters": {"character_id": "characters", "movie_id": "movies"},
+    "conversations": {"conversation_id": "conversations", "character1_id": "characters", "character2_id": "characters", "movie_id": "movies"},
+    "lines": {"line_id": "lines", "character_id": "characters", "movie_id": "movies", "conversation_id": "conversations"},
+}
+TABLES = ("movies", "characters", "conversations", "lines")
+
+WORDS = (
+    "you i the to a it what that is and no know not me don't in we this of your "
+    "yeah right here have do just go get all was be on there he oh can she with "
+    "want okay think well so him about like for why how they now got gonna love "
+    "look come never out where tell good sorry something mean sure back man"
+).split()
+
+BATCH_SIZE = 50000
+
+
+def synthetic_lines(conversations: list, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    # roughly zipf distributed, like real dialogue
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    lines = []
+    for convo in conversations:
+        for line_sort in range(rng.randint(2, 12)):
+            lines.append({
+                "line_id": len(lines),
+                "character_id": convo["character1_id"] if line_sort % 2 == 0 else convo["character2_id"],
+                "movie_id": convo["movie_id"],
+                "conversation_id": convo["conversation_id"],
+                "line_sort": line_sort,
+                "line_text": " ".join(rng.choices(WORDS, weights, k=rng.randint(2, 20))),
+            })
+    return lines
+
+
+def base_rows(lines_csv: str = None) -> dict:
+    rows = {}
+    for name, csv_name in sqlite_db.CSV_TABLES:
+        rows[name] = list(sqlite_db.read_csv(os.path.join(sqlite_db.ROOT, csv_name), db.metadata.tables[name]))
+    if lines_csv is not None:
+        rows["lines"] = list(sqlite_db.read_csv(lines_csv, db.lines))
+    else:
+        rows["lines"] = synthetic_lines(rows["conversations"])
+    return rows
+
+
+def scaled(rows: dict, scale: int):
+    """
+    Yields (table name, rows of one copy), copy by copy.
+    """
+    strides = {name: max(row[next(iter(ID_COLUMNS[name]))] for row in rows[name]) + 1 for name in TABLES}
+    for copy in range(scale):
+        for name in TABLES:
+            shifts = {column: copy * strides[table] for column, table in ID_COLUMNS[name].items()}
+            yield name, [{column: value + shifts[column] if column in shifts and value is not None else value for column, value in row.items()} for row in rows[name]]
+
+
+def insert(conn, table: sqlalchemy.Table, rows: list):
+    if conn.dialect.name == "postgresql":
+        # COPY, an order of magnitude faster than batched inserts at 100x
+        columns = [c.name for c in table.columns]
+        cursor = conn.connection.driver_connection.cursor()
+        for start in range(0, len(rows), BATCH_SIZE):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows[start:start + BATCH_SIZE]:
+                writer.writerow([r"\N" if row.get(c) is None else row[c] for c in columns])
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    else:
+        for start in range(0, len(rows), BATCH_SIZE):
+            conn.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def target_engine(reset: bool):
+    if db.backend() == "sqlite":
+        path = sqlite_db.default_path()
+        if os.path.exists(path):
+            if not reset:
+                raise SystemExit(f"{path} exists, pass --reset to replace it")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        return sqlalchemy.create_engine(sqlite_db.url(path))
+
+    # a plain engine, without DB_STATEMENT_TIMEOUT_MS and friends
+    engine = sqlalchemy.create_engine(db.database_connection_url())
+    with engine.begin() as conn:
+        existing = set(sqlalchemy.inspect(conn).get_table_names())
+        if existing & set(db.metadata.tables):
+            if not reset:
+                raise SystemExit("the database already has the tables, pass --reset to replace them")
+            for name in list(db.metadata.tables) + ["schema_migrations"]:
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {name} CASCADE")
+    return engine
+
+
+def seed(scale: int = 1, lines_csv: str = None, reset: bool = False) -> dict:
+    rows = base_rows(lines_csv)
+    engine = target_engine(reset)
+    counts = dict.fromkeys(TABLES, 0)
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            if engine.dialect.name == "sqlite":
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+            for name, copy in scaled(rows, scale):
+                insert(conn, db.metadata.tables[name], copy)
+                counts[name] += len(copy)
+        migrate.migrate(engine)
+        with engine.connect() as conn:
+            conn.exec_driver_sql("ANALYZE")
+            conn.commit()
+    finally:
+        engine.dispose()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1, help="copies of the data to load, e.g. 10 or 100")
+    parser.add_argument("--lines", default=None, help="lines csv, synthetic lines without one")
+    parser.add_argument("--reset", action="store_true", help="replace existing tables")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = seed(args.scale, args.lines, args.reset)
+    print(f"seeded {db.backend()} at {args.scale}x in {time.perf_counter() - start:.1f} s: " + ", ".join(f"{n} {name}" for name, n in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+-- The four tables of the movie dialog dataset, as the app expects them. A
+-- fresh database gets them from here; on the existing one they are already
+-- there and every statement is a no-op. Keep in sync with the table
+-- definitions in src/database.py.
+
+CREATE TABLE IF NOT EXISTS movies (
+    movie_id integer PRIMARY KEY,
+    title text,
+    year integer,
+    imdb_rating double precision,
+    imdb_votes integer,
+    raw_script_url text
+);
+
+CREATE TABLE IF NOT EXISTS characters (
+    character_id integer PRIMARY KEY,
+    name text,
+    movie_id integer REFERENCES movies (movie_id),
+    gender text,
+    age integer
+);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id integer PRIMARY KEY,
+    character1_id integer REFERENCES characters (character_id),
+    character2_id integer REFERENCES characters (character_id),
+    movie_id integer REFERENCES movies (movie_id)
+);
+
+CREATE TABLE IF NOT EXISTS lines (
+    line_id integer PRIMARY KEY,
+    character_id integer REFERENCES characters (character_id),
+    movie_id integer REFERENCES movies (movie_id),
+    conversation_id integer REFERENCES conversations (conversation_id),
+    line_sort integer,
+    line_text text
+);
@@ -0,0 +1,62 @@
+-- Line count aggregates so the read endpoints don't group the whole lines
+-- table on every request. POST /movies/{movie_id}/conversations/ keeps these
+-- up to date in the same transaction as the inserted lines.
+
+CREATE TABLE IF NOT EXISTS character_line_counts (
+    character_id integer PRIMARY KEY REFERENCES characters (character_id),
+    line_count integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS conversation_line_counts (
+    conversation_id integer PRIMARY KEY REFERENCES conversations (conversation_id),
+    line_count integer NOT NULL DEFAULT 0,
+    character1_lines integer NOT NULL DEFAULT 0,
+    character2_lines integer NOT NULL DEFAULT 0
+);
+
+-- stored in both directions so a character's partners are one index range
+CREATE TABLE IF NOT EXISTS character_pair_line_counts (
+    character_id integer NOT NULL REFERENCES characters (character_id),
+    other_character_id integer NOT NULL REFERENCES characters (character_id),
+    line_count integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (character_id, other_character_id)
+);
+
+CREATE INDEX IF NOT EXISTS character_line_counts_line_count_idx
+    ON character_line_counts (line_count DESC, character_id);
+
+CREATE INDEX IF NOT EXISTS conversation_line_counts_line_count_idx
+    ON conversation_line_counts (line_count DESC, conversation_id);
+
+-- backfill from the lines that are already there
+
+INSERT INTO character_line_counts (character_id, line_count)
+SELECT l.character_id, COUNT(*)
+FROM lines AS l
+JOIN characters AS c ON c.character_id = l.character_id
+GROUP BY l.character_id;
+
+INSERT INTO conversation_line_counts (conversation_id, line_count, character1_lines, character2_lines)
+SELECT
+    c.conversation_id,
+    COUNT(*),
+    SUM(CASE WHEN l.character_id = c.character1_id THEN 1 ELSE 0 END),
+    SUM(CASE WHEN l.character_id = c.character2_id THEN 1 ELSE 0 END)
+FROM conversations AS c
+JOIN lines AS l ON l.conversation_id = c.conversation_id
+GROUP BY c.conversation_id;
+
+INSERT INTO character_pair_line_counts (character_id, other_character_id, line_count)
+SELECT pairs.character_id, pairs.other_character_id, SUM(pairs.line_count)
+FROM (
+    SELECT c.character1_id AS character_id, c.character2_id AS other_character_id, clc.line_count
+    FROM conversations AS c
+    JOIN conversation_line_counts AS clc ON clc.conversation_id = c.conversation_id
+    WHERE c.character1_id != c.character2_id
+    UNION ALL
+    SELECT c.character2_id, c.character1_id, clc.line_count
+    FROM conversations AS c
+    JOIN conversation_line_counts AS clc ON clc.conversation_id = c.conversation_id
+    WHERE c.character1_id != c.character2_id
+) AS pairs
+GROUP BY pairs.character_id, pairs.other_character_id;
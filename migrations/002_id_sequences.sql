@@ -0,0 +1,32 @@
+-- dialect: postgresql
+-- Conversation and line ids come from the database instead of MAX(id) + 1, so
+-- concurrent inserts can never pick the same id. Columns that are already
+-- identity/serial are left alone, everything else gets an owned sequence.
+-- Either way the sequence is moved past the ids that already exist.
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'conversations' AND column_name = 'conversation_id'
+            AND (is_identity = 'YES' OR column_default IS NOT NULL)
+    ) THEN
+        CREATE SEQUENCE IF NOT EXISTS conversations_conversation_id_seq OWNED BY conversations.conversation_id;
+        ALTER TABLE conversations ALTER COLUMN conversation_id SET DEFAULT nextval('conversations_conversation_id_seq');
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'lines' AND column_name = 'line_id'
+            AND (is_identity = 'YES' OR column_default IS NOT NULL)
+    ) THEN
+        CREATE SEQUENCE IF NOT EXISTS lines_line_id_seq OWNED BY lines.line_id;
+        ALTER TABLE lines ALTER COLUMN line_id SET DEFAULT nextval('lines_line_id_seq');
+    END IF;
+END $$;
+
+SELECT setval(pg_get_serial_sequence('conversations', 'conversation_id'), COALESCE(MAX(conversation_id), 0) + 1, false)
+FROM conversations;
+
+SELECT setval(pg_get_serial_sequence('lines', 'line_id'), COALESCE(MAX(line_id), 0) + 1, false)
+FROM lines;
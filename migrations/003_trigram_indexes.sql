@@ -0,0 +1,11 @@
+-- dialect: postgresql
+-- Substring search for the name filters of /movies/ and /characters/. With a
+-- pg_trgm GIN index ILIKE '%fragment%' no longer scans the whole table, at
+-- least for fragments of three or more characters (shorter ones have no
+-- trigram to look up and the planner keeps the scan).
+-- Other backends use the in-process index from src/ngram.py instead.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS movies_title_trgm_idx ON movies USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS characters_name_trgm_idx ON characters USING gin (name gin_trgm_ops);
@@ -0,0 +1,9 @@
+-- dialect: postgresql
+-- Full-text search over line_text for /lines/search. The tsvector is a stored
+-- generated column, so a line is indexed by the statement that inserts it,
+-- inside the same transaction (add_conversation included).
+
+ALTER TABLE lines ADD COLUMN IF NOT EXISTS line_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(line_text, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS lines_line_tsv_idx ON lines USING gin (line_tsv);
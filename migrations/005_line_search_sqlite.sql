@@ -0,0 +1,23 @@
+-- dialect: sqlite
+-- Full-text search over line_text for /lines/search on the local backend: an
+-- FTS5 inverted index over the lines table, kept in sync by triggers so a
+-- line is indexed in the transaction that writes it.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(
+    line_text, content='lines', content_rowid='line_id', tokenize='porter unicode61'
+);
+
+CREATE TRIGGER IF NOT EXISTS lines_fts_insert AFTER INSERT ON lines BEGIN
+    INSERT INTO lines_fts (rowid, line_text) VALUES (new.line_id, new.line_text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS lines_fts_delete AFTER DELETE ON lines BEGIN
+    INSERT INTO lines_fts (lines_fts, rowid, line_text) VALUES ('delete', old.line_id, old.line_text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS lines_fts_update AFTER UPDATE OF line_text ON lines BEGIN
+    INSERT INTO lines_fts (lines_fts, rowid, line_text) VALUES ('delete', old.line_id, old.line_text);
+    INSERT INTO lines_fts (rowid, line_text) VALUES (new.line_id, new.line_text);
+END;
+
+INSERT INTO lines_fts (lines_fts) VALUES ('rebuild');
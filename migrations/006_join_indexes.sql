@@ -0,0 +1,17 @@
+-- Indexes for the joins and filters the endpoints run on every request:
+--   lines of a conversation in order     lines (conversation_id, line_sort)
+--   lines of a character, by conversation lines (character_id, conversation_id)
+--   conversations of a character          conversations (character1_id), (character2_id),
+--                                         one per side of the OR
+--   characters of a movie                 characters (movie_id)
+--   characters by name (/lines/names/)    characters (name)
+-- test/test_indexes.py checks the endpoint queries are planned on them.
+
+CREATE INDEX IF NOT EXISTS lines_conversation_id_idx ON lines (conversation_id, line_sort);
+CREATE INDEX IF NOT EXISTS lines_character_id_conversation_id_idx ON lines (character_id, conversation_id);
+CREATE INDEX IF NOT EXISTS lines_movie_id_idx ON lines (movie_id);
+CREATE INDEX IF NOT EXISTS conversations_character1_id_idx ON conversations (character1_id);
+CREATE INDEX IF NOT EXISTS conversations_character2_id_idx ON conversations (character2_id);
+CREATE INDEX IF NOT EXISTS conversations_movie_id_idx ON conversations (movie_id);
+CREATE INDEX IF NOT EXISTS characters_movie_id_idx ON characters (movie_id);
+CREATE INDEX IF NOT EXISTS characters_name_idx ON characters (name);
@@ -1,17 +1,22 @@
 from collections import defaultdict
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from enum import Enum
 from collections import Counter
+from typing import Optional
 from sqlalchemy import *
 
 from fastapi.params import Query
 from src import database as db
+from src import cache
+from src import ngram
+from src import snapshot
+from src.api import pagination
 
 router = APIRouter()
 
 
 @router.get("/characters/{id}", tags=["characters"])
-def get_character(id: int):
+async def get_character(id: int, limit: Optional[int] = Query(None, ge=1)):
     """
     This endpoint returns a single character by its identifier. For each character
     it returns:
@@ -30,36 +35,64 @@ def get_character(id: int):
     * `gender`: The gender of the character.
     * `number_of_lines_together`: The number of lines the character has with the
       originally queried character.
+
+    `limit` caps how many top conversations are returned, all of them by default.
     """
 
-    # TODO: Implement the endpoint using sql 
-    # for conversations
-        # query to get all the conversations the character is part of 
+    key = cache.key("get_character", id=id, limit=limit)
+    json = cache.response_cache.get(key)
+    if json is not None:
+        return json
+
+    # one round trip: the character, its movie and its partners ranked by
+    # lines together. The left joins keep the character row when it has no
+    # partners. With a limit the partners are cut down in a subquery first,
+    # read in order off the (character_id, other_character_id) key.
+    partners = "character_pair_line_counts AS p ON p.character_id = c.character_id"
+    if limit is not None:
+        partners = """(
+                SELECT character_id, other_character_id, line_count
+                FROM character_pair_line_counts
+                WHERE character_id = :id
+                ORDER BY line_count DESC, other_character_id
+                LIMIT :limit
+            ) AS p ON p.character_id = c.character_id"""
+
+    def read(conn):
+        rows = conn.execute(text(f"""
+            SELECT c.character_id, c.name, c.gender, m.title,
+                other.character_id AS other_id, other.name AS other_name, other.gender AS other_gender, p.line_count
+            FROM characters AS c
+            LEFT JOIN movies AS m ON m.movie_id = c.movie_id
+            LEFT JOIN {partners}
+            LEFT JOIN characters AS other ON other.character_id = p.other_character_id
+            WHERE c.character_id = :id
+            ORDER BY p.line_count DESC, p.other_character_id
+        """), {"id": id, "limit": limit}).fetchall()
+        if len(rows) == 0:
+            return None
+        character = rows[0]
+        return {
+            "character_id": character.character_id,
+            "character": character.name,
+            "movie": character.title,
+            "gender": character.gender,
+            "top_conversations": [{
+                "character_id": row.other_id,
+                "character": row.other_name,
+                "gender": row.other_gender,
+                "number_of_lines_together": row.line_count
+            } for row in rows if row.other_id is not None]
+        }
 
-    json = None
-    with db.engine.connect() as conn:
-        character = conn.execute(text("SELECT * FROM characters WHERE character_id = :id"), {"id":id}).fetchone()
-        if character:
-            convos = conn.execute(text("SELECT char.character_id, char.name, char.gender, mov.title, SUM(c.line_count) as count FROM (SELECT c.conversation_id, c.movie_id, CASE WHEN c.character1_id = :id THEN c.character2_id ELSE c.character1_id END AS other_character_id, COUNT(l.line_id) AS line_count FROM conversations AS c JOIN lines AS l on c.conversation_id = l.conversation_id WHERE (c.character1_id = :id OR c.character2_id = :id) AND (c.character1_id != :id OR c.character2_id != :id) GROUP BY c.conversation_id, c.movie_id, other_character_id) AS c JOIN characters AS char ON c.other_character_id = char.character_id JOIN movies AS mov on c.movie_id = mov.movie_id GROUP BY char.character_id, char.name, char.gender, mov.title ORDER BY SUM(c.line_count) DESC"), {"id": id}).fetchall()
-            cJson = []
-            for convo in convos:
-                cur = {
-                    "character_id": convo.character_id,
-                    "character": convo.name,
-                    "gender": convo.gender,
-                    "number_of_lines_together": convo.count
-                }
-                cJson.append(cur)
-
-            json = {
-                "character_id": character.character_id,
-                "character": character.name,
-                "movie": conn.execute(text("SELECT * FROM movies WHERE movie_id = :id"), {"id":character.movie_id}).fetchone().title,
-                "gender": character.gender,
-                "top_conversations": cJson
-            }
+    if snapshot.enabled():
+        json = (await snapshot.get()).get_character(id, limit)
+    else:
+        json = await db.run(read)
     if json is None:
         raise HTTPException(status_code=404, detail="character not found.")
+
+    await cache.response_cache.aset(key, json, tags=[f"character:{id}"])
     return json
 
     json = None
@@ -123,11 +156,13 @@ class character_sort_options(str, Enum):
 
 
 @router.get("/characters/", tags=["characters"])
-def list_characters(
+async def list_characters(
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: character_sort_options = character_sort_options.character,
+    cursor: Optional[str] = None,
 ):
     """
     This endpoint returns a list of characters. For each character it returns:
@@ -149,28 +184,51 @@ def list_characters(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
-    """
 
-    metadata = MetaData()
-    characters = Table("characters", metadata, autoload_with=db.engine)
-    movies = Table("movies", metadata, autoload_with=db.engine)
-    lines = Table("lines", metadata, autoload_with=db.engine)   # used to calculate the number of lines
+    For deep pages use the `cursor` query parameter instead of `offset`. Every
+    full page sets an `X-Next-Cursor` response header, passing it back as
+    `cursor` (with the same `name` and `sort`) returns the following page.
+    `offset` is ignored when a cursor is given.
+    """
+    key = cache.key("list_characters", name=name.lower(), limit=limit, offset=offset, sort=sort, cursor=cursor)
+    cached = cache.response_cache.get(key)
+    if cached is not None:
+        json, next_cursor = cached
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return json
+
+    characters = db.characters
+    movies = db.movies
+    line_counts = db.character_line_counts   # precomputed number of lines
 
     
     if sort == character_sort_options.character:
-        s = characters.c.name
+        s = (characters.c.name, False)
     elif sort == character_sort_options.movie:
-        s = movies.c.title
+        s = (movies.c.title, False)
     elif sort == character_sort_options.number_of_lines:
-        s = desc("line_count")
-    query = characters.join(lines, characters.c.character_id == lines.c.character_id).join(movies, characters.c.movie_id == movies.c.movie_id).select().with_only_columns(characters.c.character_id, characters.c.name, characters.c.movie_id, func.count(lines.c.line_id).label("line_count"), movies.c.title).group_by(characters.c.character_id, movies.c.title)
-    if name != "":
-        query = query.where(characters.c.name.ilike(f"%{name}%"))
+        s = (line_counts.c.line_count, True)
+    keys = [s, (characters.c.character_id, False)]
 
-    query = query.order_by(s, characters.c.character_id).limit(limit).offset(offset)
-    
-    with db.engine.connect() as conn:
-        result = conn.execute(query).fetchall()
+    after = pagination.decode_cursor(cursor, sort, keys) if cursor is not None else None
+
+    if snapshot.enabled():
+        # every sort order is presorted in memory, a page is a slice
+        json = (await snapshot.get()).list_characters(name, sort, limit, offset if after is None else 0, after)
+    else:
+        query = characters.join(line_counts, characters.c.character_id == line_counts.c.character_id).join(movies, characters.c.movie_id == movies.c.movie_id).select().with_only_columns(characters.c.character_id, characters.c.name, characters.c.movie_id, line_counts.c.line_count, movies.c.title)
+        if name != "":
+            query = query.where(await ngram.contains(characters.c.character_id, characters.c.name, name))
+
+        if after is not None:
+            query = query.where(pagination.after(keys, after))
+        else:
+            query = query.offset(offset)
+
+        query = query.order_by(*pagination.order_by(keys)).limit(limit)
+
+        result = await db.run(lambda conn: conn.execute(query).fetchall())
         json = []
         for row in result:
             cur = {
@@ -181,6 +239,12 @@ def list_characters(
             }
             json.append(cur)
 
+    # the sort options are named after the fields they sort on
+    next_cursor = pagination.next_cursor(sort, json, limit, lambda row: [row[sort], row["character_id"]])
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    await cache.response_cache.aset(key, (json, next_cursor), tags=["characters"])
     return json
     # filter out
     if name != "":
@@ -1,8 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Body, HTTPException
 from src import database as db
+from src import cache
+from src import snapshot
 from pydantic import BaseModel
 from typing import List
 from datetime import datetime
+from collections import defaultdict
 from sqlalchemy import *
 
 
@@ -19,11 +22,182 @@ class ConversationJson(BaseModel):
     lines: List[LinesJson]
 
 
+class BulkConversationJson(ConversationJson):
+    movie_id: int
+
+
 router = APIRouter()
 
 
+def conversation_error(movie_id: int, conversation: ConversationJson, movie_ids: set, character_movies: dict):
+    """
+    Runs the checks of a new conversation against already looked up movie ids
+    and character -> movie ids. Returns (status_code, detail) for the first
+    failed check, None if the conversation is valid.
+    """
+
+    # check 1 - movie exists
+    if movie_id not in movie_ids:
+        return 404, "movie not found."
+
+    # check 2 - characters exist and are part of the movie
+    if character_movies.get(conversation.character_1_id) != movie_id or character_movies.get(conversation.character_2_id) != movie_id:
+        return 400, "characters not in movie."
+
+    # check 3 - characters are not the same
+    if conversation.character_1_id == conversation.character_2_id:
+        return 400, "characters are the same."
+
+    # check 4 - lines match the characters
+    for line in conversation.lines:
+        if line.character_id != conversation.character_1_id and line.character_id != conversation.character_2_id:
+            return 400, "line character id does not match given characters."
+
+    return None
+
+
+def create_conversation(conn, movie_id: int, conversation: ConversationJson) -> int:
+    """
+    Validates and writes one conversation on the caller's transaction and
+    returns its id. Raises HTTPException for invalid input, nothing has been
+    written at that point.
+    """
+
+    # movie and both characters in one lookup
+    found = conn.execute(text("SELECT m.movie_id, c.character_id FROM movies AS m LEFT JOIN characters AS c ON c.movie_id = m.movie_id AND c.character_id IN (:c1, :c2) WHERE m.movie_id = :movie_id"), {"movie_id": movie_id, "c1": conversation.character_1_id, "c2": conversation.character_2_id}).fetchall()
+    movie_ids = {row.movie_id for row in found}
+    character_movies = {row.character_id: row.movie_id for row in found if row.character_id is not None}
+
+    error = conversation_error(movie_id, conversation, movie_ids, character_movies)
+    if error is not None:
+        raise HTTPException(status_code=error[0], detail=error[1])
+
+    # create the conversation, the id comes from the table's sequence
+    convo_id = conn.execute(db.conversations.insert().values(character1_id=conversation.character_1_id, character2_id=conversation.character_2_id, movie_id=movie_id).returning(db.conversations.c.conversation_id)).scalar_one()
+
+    insert_lines(conn, [(convo_id, movie_id, conversation)])
+    return convo_id
+
+
+def insert_lines(conn, new_conversations):
+    """
+    new_conversations is a list of (conversation_id, movie_id, ConversationJson)
+    whose conversation rows already exist. All of their lines go in as one
+    multi-row insert (line ids come from their sequence) and the line count
+    aggregates are bumped on the same transaction.
+    """
+    rows = [
+        {"character_id": line.character_id, "movie_id": movie_id, "conversation_id": convo_id, "line_sort": s, "line_text": line.line_text}
+        for convo_id, movie_id, conversation in new_conversations
+        for s, line in enumerate(conversation.lines)
+    ]
+    if len(rows) > 0:
+        conn.execute(db.lines.insert(), rows)
+
+    update_line_counts(conn, [(convo_id, conversation) for convo_id, _, conversation in new_conversations])
+
+
+def create_conversations(conn, conversations):
+    """
+    Validates and writes a batch of BulkConversationJson on the caller's
+    transaction. Returns the per-conversation results (without ids yet) and
+    the (conversation_id, (index, conversation)) pairs that were written.
+    """
+    movie_ids = list({c.movie_id for c in conversations})
+    character_ids = list({i for c in conversations for i in (c.character_1_id, c.character_2_id)})
+
+    # set-based lookups for every movie and character in the request
+    found_movies = set(conn.execute(select(db.movies.c.movie_id).where(db.movies.c.movie_id.in_(movie_ids))).scalars().all()) if movie_ids else set()
+    character_movies = dict(conn.execute(select(db.characters.c.character_id, db.characters.c.movie_id).where(db.characters.c.character_id.in_(character_ids))).all()) if character_ids else {}
+
+    results = []
+    valid = []
+    for i, conversation in enumerate(conversations):
+        error = conversation_error(conversation.movie_id, conversation, found_movies, character_movies)
+        if error is None:
+            results.append({"index": i})
+            valid.append((i, conversation))
+        else:
+            results.append({"index": i, "status_code": error[0], "detail": error[1]})
+
+    # ids for all the new conversations in one round trip
+    ids = db.allocate_ids(conn, "conversations", "conversation_id", len(valid))
+    if len(valid) > 0:
+        conn.execute(db.conversations.insert(), [
+            {"conversation_id": convo_id, "character1_id": c.character_1_id, "character2_id": c.character_2_id, "movie_id": c.movie_id}
+            for convo_id, (_, c) in zip(ids, valid)
+        ])
+    insert_lines(conn, [(convo_id, c.movie_id, c) for convo_id, (_, c) in zip(ids, valid)])
+    return results, list(zip(ids, valid))
+
+
+def cache_tags(movie_id: int, character_1_id: int, character_2_id: int) -> list:
+    # every cached response a new conversation shows up in
+    return [
+        f"movie:{movie_id}",
+        f"character:{character_1_id}",
+        f"character:{character_2_id}",
+        "characters",
+        "conversations",
+    ]
+
+
+async def committed(created):
+    """
+    Brings the read side up to date with conversations that just committed,
+    a list of (conversation_id, movie_id, ConversationJson). The cache is
+    swept once for all of them.
+    """
+    tags = set()
+    for convo_id, movie_id, conversation in created:
+        snapshot.apply_conversation(convo_id, movie_id, conversation.character_1_id, conversation.character_2_id, [(line.character_id, line.line_text) for line in conversation.lines])
+        tags.update(cache_tags(movie_id, conversation.character_1_id, conversation.character_2_id))
+    if tags:
+        await cache.response_cache.ainvalidate(*sorted(tags))
+
+
+def update_line_counts(conn, new_conversations):
+    """
+    Adds the lines of newly created conversations, a list of
+    (conversation_id, ConversationJson), to the precomputed line count tables.
+    Has to run on the same connection/transaction as the insert so the
+    counters never drift from the lines table.
+    """
+    per_character = defaultdict(int)
+    per_pair = defaultdict(int)
+    per_conversation = []
+    for convo_id, conversation in new_conversations:
+        if len(conversation.lines) == 0:
+            continue
+        counts = {conversation.character_1_id: 0, conversation.character_2_id: 0}
+        for line in conversation.lines:
+            counts[line.character_id] += 1
+            per_character[line.character_id] += 1
+        per_pair[(conversation.character_1_id, conversation.character_2_id)] += len(conversation.lines)
+        per_pair[(conversation.character_2_id, conversation.character_1_id)] += len(conversation.lines)
+        per_conversation.append({
+            "conversation_id": convo_id,
+            "line_count": len(conversation.lines),
+            "character1_lines": counts[conversation.character_1_id],
+            "character2_lines": counts[conversation.character_2_id],
+        })
+
+    if len(per_conversation) == 0:
+        return
+
+    conn.execute(
+        text("INSERT INTO character_line_counts (character_id, line_count) VALUES (:id, :n) ON CONFLICT (character_id) DO UPDATE SET line_count = character_line_counts.line_count + excluded.line_count"),
+        [{"id": c, "n": n} for c, n in per_character.items()],
+    )
+    conn.execute(db.conversation_line_counts.insert(), per_conversation)
+    conn.execute(
+        text("INSERT INTO character_pair_line_counts (character_id, other_character_id, line_count) VALUES (:id, :other, :n) ON CONFLICT (character_id, other_character_id) DO UPDATE SET line_count = character_pair_line_counts.line_count + excluded.line_count"),
+        [{"id": c, "other": other, "n": n} for (c, other), n in per_pair.items()],
+    )
+
+
 @router.post("/movies/{movie_id}/conversations/", tags=["movies"])
-def add_conversation(movie_id: int, conversation: ConversationJson):
+async def add_conversation(movie_id: int, conversation: ConversationJson):
     """
     This endpoint adds a conversation to a movie. The conversation is represented
     by the two characters involved in the conversation and a series of lines between
@@ -40,59 +214,19 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
 
     Limitations:
         1. if someone performs a GET request while information from a POST request were being added to the database from another call, they will not be able to access the data as it is being added
-        2. If two POST requests are being processed at the same time, a race condition can occur for attributes such as 'character1_lines' due to the fact that two proceses are trying to modify the attribute at the same time. This will of course end up in inaccurate data
-            - this can also occur in terms of the line id as the lines could be out of order and not near other lines of the same conversation
-        3. As a result of a race condition, duplicate lines/ conversations can be added to the database
-        4. Besides a race condition, there is the limitation of users being able to add the same conversation twice
+        2. Conversation and line ids come from database sequences, so two POST requests processed at the same time never get the same id. The line count aggregates are incremented in the same transaction as the lines so they stay accurate
+            - line ids of concurrent requests can interleave, the lines of one conversation are not guaranteed to have consecutive ids (line_sort keeps their order)
+        3. Sequence values used by a transaction that fails are not handed out again, so ids can have gaps
+        4. Users are able to add the same conversation twice
             - this api does not evaluate whether or not the conversation already exists in the database
-        5. A race condition can not only prevent there from being accurate data being displayed, but it can also cause errors such as finding a certain conversation based off its id
-            - if the id isn't created yet, then it wont be accessed, causing an error and resulting in the pending api request to fail out
-
-    """
-
-    # TODO:
-    # 1. Check that the movie exists
-    # 2. Check that the characters exist and are part of the movie
-    # 3. Check that the characters are not the same
-    # 4. Check that the lines match the characters
-    # 5. Create the conversation
-    # 6. Create the lines
-    # 7. Return the conversation id
-
-    metadata = MetaData()
-    convos = Table('conversations', metadata, autoload_with=db.engine)
-    lines = Table('lines', metadata, autoload_with=db.engine)
-
-    with db.engine.begin() as conn:
-        
-        # check 1 - movie exists
-        c1 = conn.execute(text("SELECT * FROM movies WHERE movie_id = :id"), {"id":movie_id}).fetchone()
-        if c1 is None:
-            raise HTTPException(status_code=404, detail="movie not found.")
-        
-        # check 2 - characters exist and are part of the movie
-        c2 = conn.execute(text("SELECT * FROM characters WHERE character_id = :id AND movie_id = :movie_id"), {"id":conversation.character_1_id, "movie_id":movie_id}).fetchone()
-        c3 = conn.execute(text("SELECT * FROM characters WHERE character_id = :id AND movie_id = :movie_id"), {"id": conversation.character_2_id, "movie_id":movie_id}).fetchone()
-        if c2 is None or c3 is None:
-            raise HTTPException(status_code=400, detail="characters not in movie.")
-        
-        # check 3 - characters are not the same
-        if conversation.character_1_id == conversation.character_2_id:
-            raise HTTPException(status_code=400, detail="characters are the same.")
-        
-        # check 4 - lines match the characters
-        for line in conversation.lines:
-            if line.character_id != conversation.character_1_id and line.character_id != conversation.character_2_id:
-                raise HTTPException(status_code=400, detail="line character id does not match given characters.")
-            
-        # create the conversation
-        convo_id = conn.execute(text("SELECT MAX(conversation_id) FROM conversations")).fetchone()[0] + 1
-        conn.execute(convos.insert().values(conversation_id=convo_id, character1_id=conversation.character_1_id, character2_id=conversation.character_2_id, movie_id=movie_id))
-
-        # create and add the lines
-        for s, line in enumerate(conversation.lines):
-            line_id = conn.execute(text("SELECT MAX(line_id) FROM lines")).fetchone()[0] + 1
-            conn.execute(lines.insert().values(line_id=line_id, character_id=line.character_id, movie_id=movie_id, conversation_id=convo_id, line_sort=s, line_text=line.line_text))
+
+    """
+
+    convo_id = await db.run(create_conversation, movie_id, conversation, begin=True)
+
+    # committed, update the snapshot and drop every cached response the new
+    # conversation shows up in
+    await committed([(convo_id, movie_id, conversation)])
     return convo_id
     # checking that the movie exists
     if movie_id not in db.movies:
@@ -143,3 +277,35 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
 
     # rerturns conversation id
     return newConvo.conversation_id
+
+
+# ids are allocated and lines inserted for the whole body in one transaction
+BULK_MAX_CONVERSATIONS = 250
+
+
+@router.post("/conversations/bulk/", tags=["movies"])
+async def add_conversations(conversations: List[BulkConversationJson] = Body(..., max_items=BULK_MAX_CONVERSATIONS)):
+    """
+    This endpoint adds many conversations, across one or more movies, in a
+    single request. Each conversation is the same as the body of
+    `/movies/{movie_id}/conversations/` plus its `movie_id`, and goes through
+    the same checks. A request takes at most 250 conversations.
+
+    All referenced movies and characters are looked up at once, the ids of the
+    valid conversations are allocated together and everything is written in one
+    transaction. Invalid conversations are skipped and reported, they don't stop
+    the valid ones from being added.
+
+    The endpoint returns one result per conversation, in request order:
+    * `index`: position of the conversation in the request body.
+    * `conversation_id`: the id of the created conversation, if it was added.
+    * `status_code` and `detail`: why the conversation was rejected, if it was not.
+    """
+
+    results, created = await db.run(create_conversations, conversations, begin=True)
+
+    for convo_id, (i, c) in created:
+        results[i]["conversation_id"] = convo_id
+    await committed([(convo_id, c.movie_id, c) for convo_id, (_, c) in created])
+
+    return results
@@ -0,0 +1,103 @@
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from enum import Enum
+from typing import Optional
+from sqlalchemy import select
+from src import database as db
+import csv
+import io
+import json
+
+router = APIRouter()
+
+# same column layouts as movies.csv, characters.csv, conversations.csv and lines.csv
+EXPORT_COLUMNS = {
+    "movies": ["movie_id", "title", "year", "imdb_rating", "imdb_votes", "raw_script_url"],
+    "characters": ["character_id", "name", "movie_id", "gender", "age"],
+    "conversations": ["conversation_id", "character1_id", "character2_id", "movie_id"],
+    "lines": ["line_id", "character_id", "movie_id", "conversation_id", "line_sort", "line_text"],
+}
+
+# rows are pulled from a server side cursor this many at a time
+BATCH_SIZE = 1000
+
+
+class export_tables(str, Enum):
+    movies = "movies"
+    characters = "characters"
+    conversations = "conversations"
+    lines = "lines"
+
+
+class export_formats(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+def export_batches(table: str, movie_id: Optional[int]):
+    """
+    Yields lists of rows in primary key order. The connection is only opened
+    once the response starts streaming and rows are never all held at once.
+    """
+    t = getattr(db, table)
+    columns = EXPORT_COLUMNS[table]
+    query = select(*[t.c[c] for c in columns]).order_by(t.c[columns[0]])
+    if movie_id is not None:
+        query = query.where(t.c.movie_id == movie_id)
+
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=BATCH_SIZE).execute(query)
+        for batch in result.partitions():
+            yield batch
+
+
+def ndjson_stream(table: str, movie_id: Optional[int]):
+    columns = EXPORT_COLUMNS[table]
+    for batch in export_batches(table, movie_id):
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in batch)
+
+
+def csv_stream(table: str, movie_id: Optional[int]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS[table])
+    for batch in export_batches(table, movie_id):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+@router.get("/export/{table}", tags=["export"])
+def export_table(
+    table: export_tables,
+    format: export_formats = export_formats.ndjson,
+    movie_id: Optional[int] = None,
+):
+    """
+    This endpoint streams a whole table, in id order, so the dataset can be
+    pulled in one request. Tables are `movies`, `characters`, `conversations`
+    and `lines`.
+
+    The `format` query parameter picks the output:
+    * `ndjson` - one json object per line.
+    * `csv` - a header row followed by the rows, with the same columns as the
+      `movies.csv`, `characters.csv` and `conversations.csv` files.
+
+    You can limit the export to a single movie with the `movie_id` query
+    parameter.
+
+    Rows are read through a server side cursor and sent as they arrive, memory
+    use doesn't depend on the size of the table.
+    """
+    if format == export_formats.csv:
+        stream, media_type = csv_stream(table.value, movie_id), "text/csv"
+    else:
+        stream, media_type = ndjson_stream(table.value, movie_id), "application/x-ndjson"
+
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table.value}.{format.value}"'},
+    )
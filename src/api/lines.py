@@ -1,11 +1,23 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from enum import Enum 
 from src import database as db
+from src import cache
+from src import line_search
+from src import snapshot
+from src.api import pagination
 from typing import *
+from json import dumps
 from sqlalchemy import *
+import logging
 
 router = APIRouter()
 
+# the list queries are logged at debug level, turn it on with
+# logging.getLogger("src.api.lines").setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
+
 
 """
 functions for lines.py
@@ -14,8 +26,122 @@ write out the first line of each conversation character is part of (searched by
 
 """
 
+# declared before /lines/{conversation_id}, which would match it otherwise
+@router.get("/lines/search", tags=["lines"])
+async def search_lines(
+    response: Response,
+    query: str,
+    limit: int = Query(50, ge=1, le=250),
+    cursor: Optional[str] = None,
+):
+    """
+    This endpoint searches the text of every line. For each matching line it returns:
+    * 'line_id': the internal id of the line
+    * 'conversation_id': the conversation the line is part of
+    * 'character': the name of the character who said the line
+    * 'movie': the title of the movie the line is from
+    * 'snippet': the part of the line that matched, matched words wrapped in <b></b>
+    * 'rank': how well the line matches, higher is better
+
+    Every word in 'query' has to match (in any form, "running" finds "run"),
+    "quoted phrases" have to match as a whole. Results are sorted by rank,
+    ties broken by line id. Every full page sets an 'X-Next-Cursor' response
+    header, passing it back as the 'cursor' query parameter (with the same
+    'query') returns the next page.
+    """
+    key = cache.key("search_lines", query=query, limit=limit, cursor=cursor)
+    cached = cache.response_cache.get(key)
+    if cached is not None:
+        json, next_cursor = cached
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return json
+
+    hits = line_search.matches(db.get_engine().dialect.name, query)
+    if hits is None:
+        return []
+    hits = hits.subquery("hits")
+    keys = [(hits.c.rank, True), (hits.c.line_id, False)]
+
+    search = hits.join(db.characters, hits.c.character_id == db.characters.c.character_id).join(db.movies, hits.c.movie_id == db.movies.c.movie_id).select().with_only_columns(hits.c.line_id, hits.c.conversation_id, db.characters.c.name, db.movies.c.title, hits.c.snippet, hits.c.rank)
+    if cursor is not None:
+        search = search.where(pagination.after(keys, pagination.decode_cursor(cursor, "rank", keys)))
+    search = search.order_by(*pagination.order_by(keys)).limit(limit)
+
+    result = await db.run(lambda conn: conn.execute(search).fetchall())
+    json = [{
+        "line_id": row.line_id,
+        "conversation_id": row.conversation_id,
+        "character": row.name,
+        "movie": row.title,
+        "snippet": row.snippet,
+        "rank": row.rank
+    } for row in result]
+
+    next_cursor = pagination.next_cursor("rank", json, limit, lambda row: [row["rank"], row["line_id"]])
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    # new conversations invalidate the "conversations" tag
+    await cache.response_cache.aset(key, (json, next_cursor), tags=["conversations"])
+    return json
+
+
+# a streamed conversation is pulled from a server side cursor this many lines at a time
+STREAM_BATCH_SIZE = 500
+
+
+def line_keys():
+    # the order of the lines of a conversation, and its cursor keys. Built on
+    # every call so the columns follow db.refresh_schema()
+    return [(db.lines.c.line_sort, False), (db.lines.c.line_id, False)]
+
+
+def conversation_head(conn, conversation_id: int) -> Optional[dict]:
+    row = conn.execute(text("SELECT m.title FROM conversations AS c JOIN movies AS m ON c.movie_id = m.movie_id WHERE c.conversation_id = :id"), {"id":conversation_id}).fetchone()
+    if row is None:
+        return None
+    return {"conversation_id": conversation_id, "title": row.title}
+
+
+def conversation_lines(conversation_id: int, after: Optional[list], *columns):
+    """
+    Lines of a conversation in line_sort order (line id breaking ties), the
+    ones after the cursor values `after` if given.
+    """
+    keys = line_keys()
+    query = select(*columns).select_from(db.lines.join(db.characters, db.lines.c.character_id == db.characters.c.character_id)).where(db.lines.c.conversation_id == conversation_id)
+    if after is not None:
+        query = query.where(pagination.after(keys, after))
+    return query.order_by(*pagination.order_by(keys))
+
+
+async def stream_lines(head: dict, batches):
+    """
+    Yields the same json document get_lines returns, one batch of (name,
+    line_text) rows from `batches` at a time.
+    """
+    def encode(value) -> str:
+        # byte for byte what JSONResponse renders
+        return dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+    yield encode(head)[:-1] + ',"lines":['
+    first = True
+    async for batch in batches:
+        chunk = ",".join(encode({"name": name, "line_text": line_text}) for name, line_text in batch)
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]}"
+
+
 @router.get("/lines/{conversation_id}", tags=["lines"])
-def get_lines(conversation_id: int):
+async def get_lines(
+    conversation_id: int,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
     """
     This endpoint returns the lines of a conversation based on its id. For each conversation, the endpoint returns
     * 'conversation_id': the conversation id of your desired conversation
@@ -25,27 +151,77 @@ def get_lines(conversation_id: int):
     Each line is represented with the following keys
     * 'name': the name of the character who said the line
     * 'line_text': the text of the line
-    
+
+    All the lines are returned by default. With 'limit' only that many are,
+    and a full page sets an 'X-Next-Cursor' response header, passing it back
+    as the 'cursor' query parameter returns the lines after it.
+
+    With 'stream=true' the same json is sent as the lines are read from the
+    database rather than built up first, for very long conversations. It
+    works with 'limit' and 'cursor' too.
     """
+    after = pagination.decode_cursor(cursor, "line_sort", line_keys()) if cursor is not None else None
+
+    # a whole conversation comes from the snapshot, when it serves reads, as below
+    if stream and not (snapshot.enabled() and limit is None and cursor is None):
+        def read_head(conn):
+            head = conversation_head(conn, conversation_id)
+            if head is None:
+                return None
+            if limit is None:
+                return head, None
+            # the header goes out before the lines do, so look up where this page ends first
+            last = conn.execute(conversation_lines(conversation_id, after, db.lines.c.line_sort, db.lines.c.line_id).offset(limit - 1).limit(1)).fetchone()
+            return head, pagination.encode_cursor("line_sort", list(last)) if last is not None else None
+
+        query = conversation_lines(conversation_id, after, db.characters.c.name, db.lines.c.line_text)
+        if limit is not None:
+            query = query.limit(limit)
+        # the head, the cursor and the lines are all read on one connection at one point in time
+        rows = db.stream(read_head, query, STREAM_BATCH_SIZE)
+        found = await rows.__anext__()
+        if found is None:
+            await rows.aclose()
+            raise HTTPException(status_code=404, detail="conversation not found.")
+        head, next_cursor = found
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else None
+        # the background task runs after the body is sent or the client went away
+        return StreamingResponse(stream_lines(head, rows), media_type="application/json", headers=headers, background=BackgroundTask(rows.aclose))
+
+    key = cache.key("get_lines", conversation_id=conversation_id, limit=limit, cursor=cursor)
+    cached = cache.response_cache.get(key)
+    if cached is not None:
+        json, next_cursor = cached
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return json
 
-    json = None
-
-    with db.engine.connect() as conn:
-        convo = conn.execute(text("SELECT * FROM conversations WHERE conversation_id = :id"), {"id":conversation_id}).fetchone()
-        if convo:
-            lines = conn.execute(text("SELECT l.*, c.name FROM lines AS l JOIN characters AS c ON l.character_id = c.character_id WHERE l.conversation_id = :id ORDER BY line_sort"), {"id":conversation_id}).fetchall()
-            json = {
-                "conversation_id": conversation_id,
-                "title": conn.execute(text("SELECT title FROM movies WHERE movie_id = :id"), {"id":convo.movie_id}).fetchone().title,
-                "lines": [{
-                    "name": line.name,
-                    "line_text": line.line_text
-                } for line in lines]
-            }
-    
+    def read(conn):
+        json = conversation_head(conn, conversation_id)
+        if json is None:
+            return None, None
+        query = conversation_lines(conversation_id, after, db.lines.c.line_sort, db.lines.c.line_id, db.characters.c.name, db.lines.c.line_text)
+        if limit is not None:
+            query = query.limit(limit)
+        lines = conn.execute(query).fetchall()
+        json["lines"] = [{
+            "name": line.name,
+            "line_text": line.line_text
+        } for line in lines]
+        next_cursor = pagination.next_cursor("line_sort", lines, limit, lambda line: [line.line_sort, line.line_id]) if limit is not None else None
+        return json, next_cursor
+
+    # the snapshot holds the lines in order but not their line_sort, pages come from the database
+    if snapshot.enabled() and limit is None and cursor is None:
+        json, next_cursor = (await snapshot.get()).get_lines(conversation_id), None
+    else:
+        json, next_cursor = await db.run(read)
     if json is None:
         raise HTTPException(status_code=404, detail="conversation not found.")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
 
+    await cache.response_cache.aset(key, (json, next_cursor), tags=[f"conversation:{conversation_id}"])
     return json
 
     if conversation_id in db.conversations:
@@ -72,7 +248,7 @@ def get_lines(conversation_id: int):
         return json
     
 @router.get("/lines/names/{name}", tags=["lines"])
-def get_character_convos(name: str):
+async def get_character_convos(name: str):
     """
     This endpoint returns a list of characters that match the given name. For each character, the endpoint returns:
     * 'name': The character's name
@@ -85,73 +261,56 @@ def get_character_convos(name: str):
     * 'line_count': how many lines the character had in the conversation
     * 'other_charcter': the name of the other character they are talking to
     """
-    jsons = []
     name = name.upper()
-    with db.engine.connect() as conn:
-        chars = conn.execute(text("SELECT * FROM characters WHERE name = :name"), {"name":name}).fetchall()
-        if chars != []:
-            for char in chars:
-                convos = conn.execute(text("SELECT * FROM conversations WHERE character1_id = :id OR character2_id = :id"), {"id":char.character_id}).fetchall()
-                json = {
+
+    key = cache.key("get_character_convos", name=name)
+    jsons = cache.response_cache.get(key)
+    if jsons is not None:
+        return jsons
+
+    # one set-based query for every character with this name: the left joins
+    # keep characters without conversations, and the line counts come from
+    # the precomputed per-conversation counters
+    def read(conn):
+        rows = conn.execute(text("""
+            SELECT ch.character_id, c.conversation_id, m.title, other.name AS other_name,
+                COALESCE(CASE WHEN c.character1_id = ch.character_id THEN clc.character1_lines ELSE clc.character2_lines END, 0) AS line_count
+            FROM characters AS ch
+            LEFT JOIN conversations AS c ON c.character1_id = ch.character_id OR c.character2_id = ch.character_id
+            LEFT JOIN movies AS m ON m.movie_id = c.movie_id
+            LEFT JOIN characters AS other ON other.character_id = CASE WHEN c.character1_id = ch.character_id THEN c.character2_id ELSE c.character1_id END
+            LEFT JOIN conversation_line_counts AS clc ON clc.conversation_id = c.conversation_id
+            WHERE ch.name = :name
+            ORDER BY ch.character_id, c.conversation_id
+        """), {"name": name}).fetchall()
+
+        jsons = []
+        for row in rows:
+            if jsons == [] or jsons[-1]["character_id"] != row.character_id:
+                jsons.append({
                     "name": name,
-                    "character_id": char.character_id,
-                    "conversation_count": len(convos),
-                    "conversations": [{
-                        "title": conn.execute(text("SELECT title FROM movies WHERE movie_id = :id"), {"id":convo.movie_id}).fetchone().title,
-                        "line_count": conn.execute(text("SELECT COUNT(*) FROM lines AS l WHERE l.character_id = :character1_id AND l.conversation_id = :conversation_id"), {"character1_id": convo.character1_id, "conversation_id": convo.conversation_id}).fetchone()[0] if convo.character1_id == char.character_id else conn.execute(text("SELECT COUNT(*) FROM lines AS l WHERE l.character_id = :character2_id AND l.conversation_id = :conversation_id"),{"character2_id": convo.character2_id, "conversation_id": convo.conversation_id}).fetchone()[0],
-                        "other_character": conn.execute(text("SELECT name FROM characters WHERE character_id = :id"), {"id":convo.character2_id if convo.character1_id == char.character_id else convo.character1_id}).fetchone().name
-                    } for convo in convos]
-                }
-                jsons.append(json)
-    
-    if jsons == []:
-        raise HTTPException(status_code=404, detail="character not found.")
-    
-    return jsons
-    jsons = []
-
-    name = name.upper()     # turn the name into all caps in order to match the datab
-
-    if name in db.charNames:
-        for id in db.charNames[name]:
-            convos = [] #[convo for convo in data.conversations.values() if convo.character1_id == id or convo.character2_id == id]
-
-            # convo to keep only one of each conversation
-            c = {}
-            for convo in db.conversations.values():
-                if (convo.character1_id == id or convo.character2_id == id) and convo.conversation_id not in c:
-                    convos.append(convo)
-            
-            convos = sorted(convos, key=lambda x: x.conversation_id)
-
-            convosJson = []
-
-            for convo in convos:
-                if id == convo.character1_id:
-                    count = convo.character1_lines
-                    other = db.characters[convo.character2_id].name
-                else:
-                    count = convo.character2_lines
-                    other = db.characters[convo.character1_id].name
-
-                convosJson.append({
-                    "title": db.movies[convo.movie_id].title,
-                    "line_count": count,
-                    "other_character": other
-                }) 
-
-            json ={
-                "name": name,
-                "character_id": id,
-                "conversation_count": len(convos),
-                "conversations": convosJson
-            }
-            jsons.append(json)
-    
-    # this means that the name was not found
+                    "character_id": row.character_id,
+                    "conversation_count": 0,
+                    "conversations": []
+                })
+            if row.conversation_id is not None:
+                jsons[-1]["conversation_count"] += 1
+                jsons[-1]["conversations"].append({
+                    "title": row.title,
+                    "line_count": row.line_count,
+                    "other_character": row.other_name
+                })
+        return jsons
+
+    if snapshot.enabled():
+        jsons = (await snapshot.get()).get_character_convos(name)
+    else:
+        jsons = await db.run(read)
+
     if jsons == []:
         raise HTTPException(status_code=404, detail="character not found.")
 
+    await cache.response_cache.aset(key, jsons, tags=[f"character:{j['character_id']}" for j in jsons])
     return jsons
 
 class conversation_sort_options(str, Enum):
@@ -160,11 +319,13 @@ class conversation_sort_options(str, Enum):
     conversation_id = "conversation_id"
 
 @router.get("/lines/conversations/", tags=["lines"])
-def list_conversations(
+async def list_conversations(
+    response: Response,
     count: Optional[int] = None,
-    limit: int = 50,
-    offset: int = 0,
-    sort: conversation_sort_options = conversation_sort_options.conversation_id
+    limit: int = Query(50, ge=1, le=250),
+    offset: int = Query(0, ge=0),
+    sort: conversation_sort_options = conversation_sort_options.conversation_id,
+    cursor: Optional[str] = None,
 ):
     """
     This endpoint returns a list of conversations. For each conversation it returns:
@@ -181,41 +342,68 @@ def list_conversations(
     * 'line_count' - Sort based on line count, descending
     * 'title' - alphabetically sorted 
     * 'conversation_id' sorted based on conversation id's
+
+    Ties are broken by conversation id. Every full page sets an 'X-Next-Cursor'
+    response header, passing it back as the 'cursor' query parameter (with the
+    same 'count' and 'sort') returns the next page without an offset scan.
     """
-    json = None
-    metadata = MetaData()
-    conversations = Table("conversations", metadata, autoload_with=db.engine)
-    lines = Table("lines", metadata, autoload_with=db.engine)
-    movies = Table("movies", metadata, autoload_with=db.engine)
+    key = cache.key("list_conversations", count=count, limit=limit, offset=offset, sort=sort, cursor=cursor)
+    cached = cache.response_cache.get(key)
+    if cached is not None:
+        json, next_cursor = cached
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return json
 
+    conversations = db.conversations
+    line_counts = db.conversation_line_counts
+    movies = db.movies
+    character1 = db.characters.alias("character1")
+    character2 = db.characters.alias("character2")
 
-    query = conversations.join(movies, conversations.c.movie_id == movies.c.movie_id).join(lines, conversations.c.conversation_id == lines.c.conversation_id).select().with_only_columns(conversations.c.conversation_id, movies.c.title, conversations.c.character1_id, conversations.c.character2_id, func.count(lines.c.line_id).label("line_count"))
+    # both character names are joined in so the page is a single statement
+    query = conversations.join(movies, conversations.c.movie_id == movies.c.movie_id).join(character1, conversations.c.character1_id == character1.c.character_id).join(character2, conversations.c.character2_id == character2.c.character_id).join(line_counts, conversations.c.conversation_id == line_counts.c.conversation_id).select().with_only_columns(conversations.c.conversation_id, movies.c.title, character1.c.name.label("character1"), character2.c.name.label("character2"), line_counts.c.line_count)
 
-    query = query.group_by(conversations.c.conversation_id, movies.c.title, conversations.c.character1_id, conversations.c.character2_id)
     if count is not None:
-        query = query.having(func.count(lines.c.line_id) >= count)
+        query = query.where(line_counts.c.line_count >= count)
 
     if sort == conversation_sort_options.conversation_id:
-        query = query.order_by(conversations.c.conversation_id).limit(limit).offset(offset)
+        keys = []
     elif sort == conversation_sort_options.title: 
-        query = query.order_by(movies.c.title).limit(limit).offset(offset)
+        keys = [(movies.c.title, False)]
     elif sort == conversation_sort_options.line_count:
-        query = query.order_by(desc("line_count")).limit(limit).offset(offset)
+        keys = [(line_counts.c.line_count, True)]
+    keys.append((conversations.c.conversation_id, False))
 
-    
+    after = pagination.decode_cursor(cursor, sort, keys) if cursor is not None else None
+
+    if snapshot.enabled():
+        # every sort order is presorted in memory, a page is a slice
+        json = (await snapshot.get()).list_conversations(count, sort, limit, offset if after is None else 0, after)
+    else:
+        if after is not None:
+            query = query.where(pagination.after(keys, after))
+        else:
+            query = query.offset(offset)
+
+        query = query.order_by(*pagination.order_by(keys)).limit(limit)
 
-    with db.engine.connect() as conn:
-        print(query)
-        convos = conn.execute(query).fetchall()
+        logger.debug("list_conversations query: %s", query)
+        convos = await db.run(lambda conn: conn.execute(query).fetchall())
         json = [{
             "conversation_id": convo.conversation_id,
             "title": convo.title,
-            "character1": conn.execute(text("SELECT name FROM characters WHERE character_id = :id"), {"id": convo.character1_id}).fetchone().name,
-            "character2": conn.execute(text("SELECT name FROM characters WHERE character_id = :id"), {"id": convo.character2_id}).fetchone().name,
-            "line_count": convo[4]
+            "character1": convo.character1,
+            "character2": convo.character2,
+            "line_count": convo.line_count
         } for convo in convos]
 
+    # the key columns are named like the fields they end up in
+    next_cursor = pagination.next_cursor(sort, json, limit, lambda convo: [convo[c.name] for c, _ in keys])
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
 
+    await cache.response_cache.aset(key, (json, next_cursor), tags=["conversations"])
     return json
     if count:
         convos = [convo for convo in db.conversations.values() if convo.lineCount >= count]
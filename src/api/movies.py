@@ -1,6 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from enum import Enum
+from typing import Optional
 from src import database as db
+from src import cache
+from src import ngram
+from src import snapshot
+from src.api import pagination
 from sqlalchemy import *
 from fastapi.params import Query
 
@@ -9,7 +14,7 @@ router = APIRouter()
 
 
 @router.get("/movies/{movie_id}", tags=["movies"])
-def get_movie(movie_id: int):
+async def get_movie(movie_id: int):
     """
     This endpoint returns a single movie by its identifier. For each movie it returns:
     * `movie_id`: the internal id of the movie.
@@ -25,27 +30,39 @@ def get_movie(movie_id: int):
 
     """
 
-    json = None
-    with db.engine.connect() as conn:
+    key = cache.key("get_movie", movie_id=movie_id)
+    json = cache.response_cache.get(key)
+    if json is not None:
+        return json
+
+    def read(conn):
         movie = conn.execute(text("SELECT * FROM movies WHERE movie_id = :id"), {"id":movie_id}).fetchone()
-        if movie:
-            cs = conn.execute(text("SELECT c.*, COUNT(*) line_count FROM characters AS c JOIN lines AS l ON c.character_id = l.character_id WHERE c.movie_id = :id GROUP BY c.character_id ORDER BY line_count DESC"), {"id":movie_id}).fetchmany(5)
-            topCs = []
-            for c in cs:
-                topCs.append({
-                    "character_id": c.character_id,
-                    "character": c.name,
-                    "num_lines": c.line_count
-                })
-            
-            json = {
-                "movie_id": movie_id,
-                "title": movie.title,
-                "top_characters": topCs
-            }
+        if movie is None:
+            return None
+        cs = conn.execute(text("SELECT c.character_id, c.name, clc.line_count FROM characters AS c JOIN character_line_counts AS clc ON c.character_id = clc.character_id WHERE c.movie_id = :id ORDER BY clc.line_count DESC, c.character_id LIMIT 5"), {"id":movie_id}).fetchall()
+        topCs = []
+        for c in cs:
+            topCs.append({
+                "character_id": c.character_id,
+                "character": c.name,
+                "num_lines": c.line_count
+            })
+
+        return {
+            "movie_id": movie_id,
+            "title": movie.title,
+            "top_characters": topCs
+        }
+
+    if snapshot.enabled():
+        json = (await snapshot.get()).get_movie(movie_id)
+    else:
+        json = await db.run(read)
 
     if json is None:
         raise HTTPException(status_code=404, detail="movie not found.")
+
+    await cache.response_cache.aset(key, json, tags=[f"movie:{movie_id}"])
     return json        
     if movie_id in db.movies:
         chars = []
@@ -83,11 +100,13 @@ class movie_sort_options(str, Enum):
 
 # Add get parameters
 @router.get("/movies/", tags=["movies"])
-def list_movies(
+async def list_movies(
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: movie_sort_options = movie_sort_options.movie_title,
+    cursor: Optional[str] = None,
 ):
     """
     This endpoint returns a list of movies. For each movie it returns:
@@ -110,36 +129,58 @@ def list_movies(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    For deep pages use the `cursor` query parameter instead of `offset`. Every
+    full page sets an `X-Next-Cursor` response header, passing it back as
+    `cursor` (with the same `name` and `sort`) returns the following page.
+    `offset` is ignored when a cursor is given.
     """
-    metadata = MetaData()
-    movies = Table('movies', metadata, autoload_with=db.engine)
+    key = cache.key("list_movies", name=name.lower(), limit=limit, offset=offset, sort=sort, cursor=cursor)
+    cached = cache.response_cache.get(key)
+    if cached is not None:
+        json, next_cursor = cached
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return json
+
+    movies = db.movies
     if sort == movie_sort_options.movie_title:
-        s = movies.columns.title
+        s = (movies.c.title, False)
     elif sort == movie_sort_options.year:
-        s = movies.columns.year
+        s = (movies.c.year, False)
     elif sort == movie_sort_options.rating:
-        s = desc(movies.columns.imdb_rating)
+        s = (movies.c.imdb_rating, True)
     else:
-        s = movies.columns.title
+        s = (movies.c.title, False)
+    keys = [s, (movies.c.movie_id, False)]
     
     query = select(movies)
 
     if name != "":
-        query = query.where(movies.c.title.ilike(f"%{name}%"))
+        query = query.where(await ngram.contains(movies.c.movie_id, movies.c.title, name))
 
-    query = query.order_by(s, movies.c.movie_id).limit(limit).offset(offset)
+    if cursor is not None:
+        query = query.where(pagination.after(keys, pagination.decode_cursor(cursor, sort, keys)))
+    else:
+        query = query.offset(offset)
+
+    query = query.order_by(*pagination.order_by(keys)).limit(limit)
 
     json = []
-    with db.engine.connect() as conn:
-        result = conn.execute(query)
-        for row in result:
-            json.append({
-                "movie_id": row.movie_id,
-                "movie_title": row.title,
-                "year": row.year,
-                "imdb_rating": row.imdb_rating,
-                "imdb_votes": row.imdb_votes
-            })
+    result = await db.run(lambda conn: conn.execute(query).fetchall())
+    next_cursor = pagination.next_cursor(sort, result, limit, lambda row: [row._mapping[s[0].name], row.movie_id])
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    for row in result:
+        json.append({
+            "movie_id": row.movie_id,
+            "movie_title": row.title,
+            "year": row.year,
+            "imdb_rating": row.imdb_rating,
+            "imdb_votes": row.imdb_votes
+        })
+
+    await cache.response_cache.aset(key, (json, next_cursor), tags=["movies"])
     return json
     
     # filtering out based on the name 
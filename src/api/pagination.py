@@ -0,0 +1,93 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+A cursor is the sort key and id of the last row of a page, base64 encoded so
+clients treat it as opaque. The next page is then read with a WHERE on those
+values instead of an OFFSET, so a deep page costs the same as the first one.
+
+Ordering is always spelled out with explicit NULLS FIRST/LAST (postgres'
+defaults) so the comparison below matches the ORDER BY on every backend.
+"""
+import base64
+import json
+from fastapi import HTTPException
+from sqlalchemy import and_, asc, desc, false, or_, true
+
+
+def encode_cursor(sort: str, values: list) -> str:
+    raw = json.dumps({"sort": sort, "after": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _matches(value, column) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, bool):
+        return False
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        # an untyped expression, any plain scalar will bind
+        return isinstance(value, (int, float, str))
+    if expected is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, expected)
+
+
+def decode_cursor(cursor: str, sort: str, keys) -> list:
+    """
+    Returns the key values stored in the cursor, one per (column, descending)
+    pair in keys. A cursor from a different sort order (or one that was
+    tampered with) is a 400.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        values = data["after"]
+        valid = data["sort"] == sort and isinstance(values, list) and len(values) == len(keys)
+        # the values end up as bind parameters, they have to fit the columns
+        valid = valid and all(_matches(value, column) for value, (column, _) in zip(values, keys))
+    except (ValueError, TypeError, KeyError):
+        valid = False
+
+    if not valid:
+        raise HTTPException(status_code=400, detail="invalid cursor.")
+    return values
+
+
+def order_by(keys):
+    """
+    keys is a list of (column, descending) pairs, the last one being the unique
+    id used as a tie breaker.
+    """
+    return [desc(c).nulls_first() if descending else asc(c).nulls_last() for c, descending in keys]
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _after(column, descending, value):
+    # nulls sort last ascending and first descending
+    if descending:
+        return column.is_not(None) if value is None else column < value
+    return false() if value is None else or_(column > value, column.is_(None))
+
+
+def after(keys, values):
+    """
+    WHERE clause matching the rows that sort strictly after `values`.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        prefix = [_equal(c, v) for (c, _), v in zip(keys[:i], values[:i])]
+        clauses.append(and_(true(), *prefix, _after(column, descending, values[i])))
+    return or_(*clauses)
+
+
+def next_cursor(sort: str, rows, limit: int, key):
+    """
+    Cursor for the page after `rows`, None if this page was the last one.
+    """
+    if len(rows) == 0 or len(rows) < limit:
+        return None
+    return encode_cursor(sort, key(rows[-1]))
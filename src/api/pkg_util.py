@@ -1,7 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+import hmac
 import os
-import pkg_resources
 import sys
+from src import cache
+from src import database as db
+from src import metrics
+from src import slow_queries
+from src import snapshot
 
 router = APIRouter()
 
@@ -24,6 +31,9 @@ def version():
 
 @router.get("/pkgsize/")
 def get_pkgsize():
+    # slow to import, only pay for it when this endpoint is hit
+    import pkg_resources
+
     dists = [d for d in pkg_resources.working_set]
 
     message = []
@@ -44,3 +54,46 @@ def get_pkgsize():
 
     message = sorted(message, key=lambda d: d["size_in_mb"], reverse=True)
     return {"message": message}
+
+
+@router.get("/cache/stats/")
+def get_cache_stats():
+    return cache.response_cache.stats()
+
+
+@router.get("/pool/stats/")
+def get_pool_stats():
+    stats = {"engine": db.pool_stats.stats()}
+    if db.async_pool_stats is not None:
+        stats["async_engine"] = db.async_pool_stats.stats()
+    return stats
+
+
+@router.get("/snapshot/stats/")
+def get_snapshot_stats():
+    return snapshot.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # prometheus text format
+    return metrics.render()
+
+
+@router.get("/slowqueries/")
+def get_slow_queries(x_debug_token: Optional[str] = Header(None)):
+    """
+    The statements the slow query log caught (see src/slow_queries.py), newest
+    first. Bind parameters can hold user data, so this needs the DEBUG_TOKEN
+    of the deployment in an X-Debug-Token header, and doesn't exist without one.
+    """
+    token = os.environ.get("DEBUG_TOKEN")
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_debug_token is None or not hmac.compare_digest(x_debug_token.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="invalid debug token.")
+
+    slow_log = slow_queries.log()
+    if slow_log is None:
+        return {"enabled": False, "queries": []}
+    return {"enabled": True, "threshold_ms": slow_log.threshold * 1000, "queries": slow_log.recent()}
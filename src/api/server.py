@@ -1,5 +1,7 @@
 from fastapi import FastAPI
-from src.api import characters, movies, conversations, lines, pkg_util
+from src import database as db
+from src import metrics
+from src.api import characters, movies, conversations, lines, pkg_util, export
 
 description = """
 Movie API returns dialog statistics on top hollywood movies from decades past.
@@ -23,6 +25,11 @@ You can:
 * **retrieve information on a character and its conversations**
 * **list conversations with sorting and filterting options.**
 
+## Export
+
+You can:
+* **stream movies, characters, conversations or lines as ndjson or csv.**
+
 """
 tags_metadata = [
     {
@@ -37,6 +44,10 @@ tags_metadata = [
         "name": "lines",
         "description": "Access informaiton on lines in movie conversations"
     },
+    {
+        "name": "export",
+        "description": "Stream whole tables as ndjson or csv."
+    },
 ]
 
 app = FastAPI(
@@ -48,12 +59,17 @@ app = FastAPI(
         "email": "kchoi21@calpoly.edu",
     },
     openapi_tags=tags_metadata,
+    default_response_class=metrics.TimedJSONResponse,
 )
+# query counts and timings per request, see src/metrics.py
+if db.env_flag("METRICS", True):
+    app.add_middleware(metrics.TimingMiddleware)
 app.include_router(characters.router)
 app.include_router(movies.router)
 app.include_router(lines.router)
 app.include_router(pkg_util.router)
 app.include_router(conversations.router)
+app.include_router(export.router)
 
 
 @app.get("/")
@@ -0,0 +1,315 @@
+"""
+Response cache for the read endpoints.
+
+Everything except POST /movies/{movie_id}/conversations/ is read only, so the
+routers keep their finished json here keyed by the normalized query params.
+Entries carry tags ("movie:44", "character:2", "characters", ...) and the POST
+drops the tags it touched once its transaction has committed.
+
+Two backends, picked with CACHE_BACKEND:
+* `memory` (default) - an LRU inside the process. Every uvicorn worker has its
+  own copy and an invalidation only reaches the worker that took the POST.
+* `sqlite` - a SQLite file (CACHE_PATH) shared by all the workers on the host,
+  so they share warm entries and an invalidation is seen by all of them. Not
+  with READ_ENGINE=snapshot, where every worker answers from its own snapshot
+  and keeps a memory cache of its own instead.
+
+Sized with CACHE_MAXSIZE (entries, 0 turns caching off) and CACHE_TTL (seconds).
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from starlette.concurrency import run_in_threadpool
+
+
+def key(endpoint: str, **params) -> str:
+    """
+    Normalized cache key, params are sorted so the order they were passed in
+    doesn't matter.
+    """
+    return endpoint + "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+
+
+class CacheBackend(ABC):
+    """
+    What the routers need from a cache. Values are json-able, must not be None
+    (None is what a miss looks like) and may come back as a copy with tuples
+    turned into lists.
+
+    The async handlers write through aset() and ainvalidate(). A backend whose
+    writes can block (`blocking`) runs them in the threadpool, like db.run.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value, tags=()):
+        ...
+
+    @abstractmethod
+    def invalidate(self, *tags):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+    async def aset(self, key: str, value, tags=()):
+        if self.blocking:
+            await run_in_threadpool(self.set, key, value, tags)
+        else:
+            self.set(key, value, tags)
+
+    async def ainvalidate(self, *tags):
+        if self.blocking:
+            await run_in_threadpool(self.invalidate, *tags)
+        else:
+            self.invalidate(*tags)
+
+
+class TTLCache(CacheBackend):
+    """
+    In-process, size bounded LRU with a per entry time to live.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires_at, value, tags)
+        self._tags = defaultdict(set)   # tag -> keys
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value, tags=()):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags[tag].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for k in list(self._tags.get(tag, ())):
+                    self._remove(k)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key: str):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache kept in a SQLite file so several worker processes share it. Recency
+    for the LRU is the last hit time, and the hit/miss counters are per
+    process while `size` is shared.
+
+    get() is called from the async handlers, so it only reads: hits are noted
+    in memory and written with the next set(), which takes the write lock
+    anyway. Expired entries are left for set() to replace or evict. set() and
+    invalidate() can wait up to the busy timeout for that lock, the handlers
+    reach them through aset() and ainvalidate() in the threadpool.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int = 1024, ttl: float = 300.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        self._used = {}   # key -> last hit time, not written yet
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_used_at_idx ON entries (used_at);
+            CREATE TABLE IF NOT EXISTS tags (tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key));
+            CREATE INDEX IF NOT EXISTS tags_key_idx ON tags (key);
+        """)
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads, one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str, n: int = 1):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def get(self, key: str):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        if row[1] < now:
+            self._count("expirations")
+            self._count("misses")
+            return None
+        with self._counter_lock:
+            if key in self._used or len(self._used) < self.maxsize:
+                self._used[key] = now
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value, tags=()):
+        if self.maxsize <= 0:
+            return
+        conn = self._conn()
+        now = time.time()
+        with self._counter_lock:
+            used, self._used = self._used, {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE entries SET used_at = max(used_at, ?) WHERE key = ?", [(t, k) for k, t in used.items()])
+            conn.execute("DELETE FROM tags WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)", (key, json.dumps(value), now + self.ttl, now))
+            conn.executemany("INSERT OR IGNORE INTO tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+            excess = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.maxsize
+            if excess > 0:
+                oldest = [r[0] for r in conn.execute("SELECT key FROM entries ORDER BY used_at LIMIT ?", (excess,))]
+                self._delete(conn, oldest)
+                self._count("evictions", len(oldest))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            placeholders = ",".join("?" * len(tags))
+            keys = [r[0] for r in conn.execute(f"SELECT DISTINCT key FROM tags WHERE tag IN ({placeholders})", tags)]
+            self._delete(conn, keys)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._count("invalidations", len(keys))
+
+    def clear(self):
+        with self._counter_lock:
+            self._used = {}
+        conn = self._conn()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM tags")
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "size": self._conn().execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def _delete(self, conn, keys):
+        conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM tags WHERE key = ?", [(k,) for k in keys])
+
+
+def make_cache() -> CacheBackend:
+    backend = os.environ.get("CACHE_BACKEND", "memory")
+    maxsize = int(os.environ.get("CACHE_MAXSIZE", "1024"))
+    ttl = float(os.environ.get("CACHE_TTL", "300"))
+
+    if backend == "sqlite":
+        from src import snapshot
+
+        # a worker's snapshot only has the conversations that worker added, one
+        # that hasn't seen a write would refill a shared file with stale
+        # responses right after the write invalidated them
+        if snapshot.enabled():
+            backend = "memory"
+
+    if backend == "memory":
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    if backend == "sqlite":
+        path = os.environ.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "movie_api_cache.sqlite3"))
+        return SQLiteCache(path, maxsize=maxsize, ttl=ttl)
+    raise ValueError(f"unknown CACHE_BACKEND {backend!r}, expected memory or sqlite")
+
+
+response_cache = make_cache()
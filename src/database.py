@@ -1,33 +1,442 @@
-from collections import defaultdict
-from sqlalchemy import create_engine
+from contextlib import nullcontext
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+from starlette.concurrency import run_in_threadpool
+import anyio
 import os
-import dotenv
+import threading
+import time
 import sqlalchemy
-import csv  # csv reader
-import io   # csv reader
-from supabase import Client, create_client
+from src import metrics
+from src import slow_queries
+
+_env_loaded = False
+
+
+def load_env():
+    # dotenv only matters once we connect, no need to pay for it at import
+    global _env_loaded
+    if not _env_loaded:
+        import dotenv
+
+        dotenv.load_dotenv()
+        _env_loaded = True
+
 
 # conenction via the supabase url
-def database_connection_url():
-
-   dotenv.load_dotenv()
-   DB_USER: str = os.environ.get("POSTGRES_USER")
-   DB_PASSWD = os.environ.get("POSTGRES_PASSWORD")
-   DB_SERVER: str = os.environ.get("POSTGRES_SERVER")
-   DB_PORT: str = os.environ.get("POSTGRES_PORT")
-   DB_NAME: str = os.environ.get("POSTGRES_DB")
-   return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
-
-# creating a new DB engine based on our connection string
-engine = sqlalchemy.create_engine(database_connection_url(), echo=True, future=True)
-
-supabase_api_key = os.environ.get("SUPABASE_API_KEY")
-supabase_url = os.environ.get("SUPABASE_URL")
-
-if supabase_api_key is None or supabase_url is None:
-    raise Exception(
-        "You must set the SUPABASE_API_KEY and SUPABASE_URL environment variables."
-    )
+def database_connection_url(driver: str = "postgresql"):
+    load_env()
+    DB_USER: str = os.environ.get("POSTGRES_USER")
+    DB_PASSWD = os.environ.get("POSTGRES_PASSWORD")
+    DB_SERVER: str = os.environ.get("POSTGRES_SERVER")
+    DB_PORT: str = os.environ.get("POSTGRES_PORT")
+    DB_NAME: str = os.environ.get("POSTGRES_DB")
+    return f"{driver}://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+def backend() -> str:
+    """
+    DB_BACKEND picks where the data lives: postgres (default, the remote
+    database) or sqlite (a local file built from the bundled csvs, see
+    src/sqlite_db.py).
+    """
+    load_env()
+    return os.environ.get("DB_BACKEND", "postgres").lower()
+
+
+def engine_options(async_mode: bool = False) -> dict:
+    """
+    Engine keyword arguments from the environment:
+        DB_ECHO                  log every statement (default off)
+        DB_NULLPOOL              open a connection per checkout instead of pooling,
+                                 on by default on Vercel where instances don't live
+                                 long enough to reuse one
+        DB_POOL_SIZE             connections kept open per worker (default 5)
+        DB_MAX_OVERFLOW          extra connections allowed under load (default 10)
+        DB_POOL_TIMEOUT          seconds to wait for a free connection (default 30)
+        DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+        DB_POOL_PRE_PING         test connections on checkout (default on)
+        DB_STATEMENT_TIMEOUT_MS  server side statement_timeout (default none,
+                                 postgres only)
+    """
+    options = {"echo": env_flag("DB_ECHO"), "pool_pre_ping": env_flag("DB_POOL_PRE_PING", True)}
+
+    if env_flag("DB_NULLPOOL", "VERCEL" in os.environ):
+        options["poolclass"] = NullPool
+    else:
+        options["pool_size"] = int(os.environ.get("DB_POOL_SIZE", "5"))
+        options["max_overflow"] = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+        options["pool_timeout"] = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+        options["pool_recycle"] = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+
+    timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "0"))
+    if timeout > 0 and backend() == "postgres":
+        # psycopg2 takes libpq options, asyncpg its own server_settings
+        if async_mode:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(timeout)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
+class PoolStats:
+    """
+    Connection pool counters of one engine, fed by pool events and by run()
+    timing how long it waited for a connection.
+    """
+
+    def __init__(self, engine):
+        self.pool = engine.pool
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        event.listen(engine, "connect", lambda *args: self._count("connects"))
+        event.listen(engine, "checkout", lambda *args: self._count("checkouts"))
+        event.listen(engine, "checkin", lambda *args: self._count("checkins"))
+        event.listen(engine, "invalidate", lambda *args: self._count("invalidations"))
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def stats(self) -> dict:
+        pool = self.pool
+        with self._lock:
+            stats = {
+                "pool": type(pool).__name__,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "wait_avg_ms": self.wait_total / self.waits * 1000 if self.waits else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+        # NullPool keeps nothing around, so it has no size to report
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+        return stats
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+# the engines are built on first use rather than at import, a cold start that
+# never touches the database (docs, /pyversion/) shouldn't pay for them
+_engine_lock = threading.Lock()
+
+# sqlite takes one writer at a time and a transaction that read before writing
+# fails instead of waiting, so writes in this process queue up here
+_sqlite_write_lock = threading.Lock()
+
+
+def create_engine_from_env():
+    if backend() == "sqlite":
+        from src import sqlite_db
+
+        path = sqlite_db.ensure_built()
+        return sqlalchemy.create_engine(sqlite_db.url(path, read_only=env_flag("SQLITE_READ_ONLY")), future=True, **engine_options())
+    return sqlalchemy.create_engine(database_connection_url(), future=True, **engine_options())
+
+
+def _instrument(engine):
+    # per request stats and the slow query log, see src/metrics.py and
+    # src/slow_queries.py
+    metrics.instrument(engine)
+    slow_queries.instrument(engine)
+
+
+def get_engine():
+    """
+    Returns the blocking engine, creating it (and its pool_stats) the first
+    time. Once created it is a plain module attribute, so `db.engine` can also
+    be reassigned, e.g. to point the app at another database.
+    """
+    if "engine" not in globals():
+        with _engine_lock:
+            if "engine" not in globals():
+                new_engine = create_engine_from_env()
+                globals()["pool_stats"] = PoolStats(new_engine)
+                _instrument(new_engine)
+                globals()["engine"] = new_engine
+    return globals()["engine"]
+
+
+def get_pool_stats() -> "PoolStats":
+    # normally made along with the engine, but not if db.engine was assigned
+    engine = get_engine()
+    if "pool_stats" not in globals():
+        with _engine_lock:
+            if "pool_stats" not in globals():
+                globals()["pool_stats"] = PoolStats(engine)
+                _instrument(engine)
+    return globals()["pool_stats"]
+
+
+def get_async_engine():
+    """
+    Returns the asyncpg engine, creating it the first time, or None when
+    DB_ASYNC is off. DB_ASYNC=1 serves the routers from it so a worker can keep
+    many queries in flight without tying up a threadpool slot for each. sqlite
+    has no network wait to overlap and always uses the blocking engine.
+    """
+    if "async_engine" not in globals():
+        with _engine_lock:
+            if "async_engine" not in globals():
+                if backend() == "postgres" and env_flag("DB_ASYNC"):
+                    from sqlalchemy.ext.asyncio import create_async_engine
+
+                    new_engine = create_async_engine(database_connection_url("postgresql+asyncpg"), **engine_options(async_mode=True))
+                    globals()["async_pool_stats"] = PoolStats(new_engine.sync_engine)
+                    _instrument(new_engine.sync_engine)
+                    globals()["async_engine"] = new_engine
+                else:
+                    globals()["async_pool_stats"] = None
+                    globals()["async_engine"] = None
+    return globals()["async_engine"]
+
+
+def __getattr__(name: str):
+    # db.engine & co. before anything created them
+    if name == "engine":
+        return get_engine()
+    if name == "pool_stats":
+        return get_pool_stats()
+    if name in ("async_engine", "async_pool_stats"):
+        get_async_engine()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def run(fn, *args, begin: bool = False):
+    """
+    Runs fn(conn, *args) on a connection and returns its result, committing at
+    the end when `begin` is set. fn is plain sync SQLAlchemy code either way:
+    with DB_ASYNC it runs on the async engine through run_sync, otherwise on the
+    blocking engine in the threadpool.
+    """
+    async_engine = get_async_engine()
+    if async_engine is not None:
+        start = time.perf_counter()
+        async with (async_engine.begin() if begin else async_engine.connect()) as conn:
+            wait = time.perf_counter() - start
+            globals()["async_pool_stats"].record_wait(wait)
+            metrics.record_pool_wait(wait)
+            return await conn.run_sync(fn, *args)
+    return await run_in_threadpool(_run_blocking, fn, args, begin)
+
+
+def _run_blocking(fn, args, begin: bool):
+    engine = get_engine()
+    with (_sqlite_write_lock if begin and engine.dialect.name == "sqlite" else nullcontext()):
+        start = time.perf_counter()
+        with (engine.begin() if begin else engine.connect()) as conn:
+            wait = time.perf_counter() - start
+            get_pool_stats().record_wait(wait)
+            metrics.record_pool_wait(wait)
+            return fn(conn, *args)
+
+
+def begin_consistent_read(conn):
+    """
+    Starts a transaction on conn in which every statement sees the database as
+    of the first one, for reads that have to agree with each other.
+    """
+    if conn.dialect.name == "sqlite":
+        # pysqlite only opens a transaction before writes, a deferred one
+        # keeps the view of its first select until it ends
+        conn.exec_driver_sql("BEGIN")
+    else:
+        conn.execution_options(isolation_level="REPEATABLE READ")
+
+
+async def stream(fn, query, batch_size: int, *args):
+    """
+    For responses that send a header before their body: runs fn(conn, *args),
+    then streams the rows of query from a server side cursor on the same
+    connection, all in one consistent read (see begin_consistent_read).
+
+    This is an async generator. Its first item is fn's result, the rest are
+    the rows in batches of batch_size. It holds the connection until it is
+    exhausted or closed with aclose(), which also works if it is cancelled
+    halfway. The engine is picked like in run().
+    """
+    query = query.execution_options(stream_results=True, yield_per=batch_size)
+
+    async_engine = get_async_engine()
+    if async_engine is not None:
+        start = time.perf_counter()
+        conn = await async_engine.connect()
+        wait = time.perf_counter() - start
+        globals()["async_pool_stats"].record_wait(wait)
+        metrics.record_pool_wait(wait)
+        try:
+            await conn.run_sync(begin_consistent_read)
+            yield await conn.run_sync(fn, *args)
+            result = await conn.stream(query)
+            async for batch in result.partitions():
+                yield batch
+        finally:
+            # a client that went away cancels the response, the connection
+            # still has to go back
+            with anyio.CancelScope(shield=True):
+                await conn.close()
+        return
+
+    conn = await run_in_threadpool(_connect_blocking)
+    try:
+        await run_in_threadpool(begin_consistent_read, conn)
+        yield await run_in_threadpool(fn, conn, *args)
+        partitions = (await run_in_threadpool(conn.execute, query)).partitions()
+        while True:
+            batch = await run_in_threadpool(next, partitions, None)
+            if batch is None:
+                break
+            yield batch
+    finally:
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(conn.close)
+
+
+def _connect_blocking():
+    start = time.perf_counter()
+    conn = get_engine().connect()
+    wait = time.perf_counter() - start
+    get_pool_stats().record_wait(wait)
+    metrics.record_pool_wait(wait)
+    return conn
+
+# shared schema registry, the routers use these instead of reflecting the
+# tables on every request (each autoload is several catalog queries)
+metadata = sqlalchemy.MetaData()
+
+movies = sqlalchemy.Table(
+    "movies",
+    metadata,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("title", sqlalchemy.Text),
+    sqlalchemy.Column("year", sqlalchemy.Integer),
+    sqlalchemy.Column("imdb_rating", sqlalchemy.Float),
+    sqlalchemy.Column("imdb_votes", sqlalchemy.Integer),
+    sqlalchemy.Column("raw_script_url", sqlalchemy.Text),
+)
+
+characters = sqlalchemy.Table(
+    "characters",
+    metadata,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.Text),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("movies.movie_id")),
+    sqlalchemy.Column("gender", sqlalchemy.Text),
+    sqlalchemy.Column("age", sqlalchemy.Integer),
+)
+
+conversations = sqlalchemy.Table(
+    "conversations",
+    metadata,
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character1_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id")),
+    sqlalchemy.Column("character2_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id")),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("movies.movie_id")),
+)
+
+lines = sqlalchemy.Table(
+    "lines",
+    metadata,
+    sqlalchemy.Column("line_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id")),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("movies.movie_id")),
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("conversations.conversation_id")),
+    sqlalchemy.Column("line_sort", sqlalchemy.Integer),
+    sqlalchemy.Column("line_text", sqlalchemy.Text),
+)
+
+# line count aggregates (migrations/001_line_counts.sql), written by
+# add_conversation so reads never have to group the lines table
+character_line_counts = sqlalchemy.Table(
+    "character_line_counts",
+    metadata,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id"), primary_key=True),
+    sqlalchemy.Column("line_count", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+
+conversation_line_counts = sqlalchemy.Table(
+    "conversation_line_counts",
+    metadata,
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("conversations.conversation_id"), primary_key=True),
+    sqlalchemy.Column("line_count", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("character1_lines", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("character2_lines", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+
+character_pair_line_counts = sqlalchemy.Table(
+    "character_pair_line_counts",
+    metadata,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id"), primary_key=True),
+    sqlalchemy.Column("other_character_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("characters.character_id"), primary_key=True),
+    sqlalchemy.Column("line_count", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+
+TABLE_NAMES = (
+    "movies",
+    "characters",
+    "conversations",
+    "lines",
+    "character_line_counts",
+    "conversation_line_counts",
+    "character_pair_line_counts",
+)
+
+
+def allocate_ids(conn, table: str, column: str, n: int) -> list:
+    """
+    Reserves n ids from the sequence behind table.column in one round trip, for
+    bulk inserts that need to know their ids up front.
+
+    sqlite has no sequences, the ids continue from MAX(column) instead. That is
+    only safe inside run(..., begin=True), where _sqlite_write_lock serializes
+    this process's writers. It doesn't cover other processes writing to the
+    same file, their ids can collide (the insert then fails on the primary key).
+    """
+    if n == 0:
+        return []
+    if conn.dialect.name == "sqlite":
+        start = conn.execute(sqlalchemy.select(sqlalchemy.func.coalesce(sqlalchemy.func.max(metadata.tables[table].c[column]), 0))).scalar_one()
+        return list(range(start + 1, start + n + 1))
+    return conn.execute(
+        sqlalchemy.text("SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :n)"),
+        {"table": table, "column": column, "n": n},
+    ).scalars().all()
+
+
+def refresh_schema():
+    """
+    Re-reflects the registry tables from the live database, use this after the
+    schema was changed underneath a running server. The module level tables are
+    swapped out so the routers pick the new definitions up on their next call.
+    """
+    global metadata
+
+    reflected = sqlalchemy.MetaData()
+    reflected.reflect(bind=get_engine(), only=TABLE_NAMES)
+
+    metadata = reflected
+    for name in TABLE_NAMES:
+        globals()[name] = reflected.tables[name]
 
 
 # # THIS CODE IS ALL FOR READING FROM CSVS DELETE DELETE DELETE
@@ -0,0 +1,60 @@
+"""
+Full-text search over line_text, for /lines/search.
+
+Postgres matches against the line_tsv column from
+migrations/004_line_search.sql, other backends against the FTS5 table from
+migrations/005_line_search_sqlite.sql. Both are filled by the database itself
+as lines are written, so a new conversation is searchable as soon as it
+commits.
+"""
+import re
+from sqlalchemy import Double, bindparam, cast, column, func, literal_column, select, table
+from src import database as db
+
+SNIPPET_START = "<b>"
+SNIPPET_STOP = "</b>"
+SNIPPET_WORDS = 16
+
+# "quoted phrases" and bare words
+_TERM = re.compile(r'"([^"]*)"|(\w+)')
+
+
+def fts5_query(query: str) -> str:
+    """
+    The search terms as an FTS5 query, every word or quoted phrase has to
+    match. Everything is quoted so user input can't be FTS5 syntax.
+    """
+    terms = []
+    for phrase, word in _TERM.findall(query):
+        words = re.findall(r"\w+", phrase) if phrase else [word]
+        if words:
+            terms.append('"' + " ".join(words) + '"')
+    return " ".join(terms)
+
+
+def matches(dialect: str, query: str):
+    """
+    Select of the lines matching query with their line_id, conversation_id,
+    character_id, movie_id, rank (higher is better) and snippet (the matched
+    words wrapped in <b></b>). None if the query has nothing to search for.
+    """
+    lines = db.lines
+    if dialect == "postgresql":
+        # inline, the same configuration the generated column was built with
+        config = literal_column("'english'::regconfig")
+        tsquery = func.websearch_to_tsquery(config, bindparam("query", query))
+        line_tsv = literal_column("lines.line_tsv")
+        # float8 so the rank round trips through a cursor exactly
+        rank = cast(func.ts_rank(line_tsv, tsquery), Double)
+        snippet = func.ts_headline(config, lines.c.line_text, tsquery, f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}")
+        return select(lines.c.line_id, lines.c.conversation_id, lines.c.character_id, lines.c.movie_id, rank.label("rank"), snippet.label("snippet")).where(line_tsv.op("@@")(tsquery))
+
+    fts_query = fts5_query(query)
+    if fts_query == "":
+        return None
+    lines_fts = table("lines_fts", column("rowid"))
+    fts = literal_column("lines_fts")
+    # bm25 is better the lower it is
+    rank = -func.bm25(fts, type_=Double)
+    snippet = func.snippet(fts, 0, SNIPPET_START, SNIPPET_STOP, "...", SNIPPET_WORDS)
+    return select(lines.c.line_id, lines.c.conversation_id, lines.c.character_id, lines.c.movie_id, rank.label("rank"), snippet.label("snippet")).select_from(lines_fts.join(lines, lines.c.line_id == lines_fts.c.rowid)).where(fts.op("MATCH")(bindparam("query", fts_query)))
@@ -0,0 +1,233 @@
+"""
+Per-request instrumentation: how many SQL statements a request ran, how long
+they took, how long it waited for a pool connection and how long rendering
+the response body took.
+
+The numbers are collected into a RequestStats kept in a contextvar for the
+duration of the request (it follows the request into the threadpool and into
+the async engine's greenlets), fed by cursor events on every engine
+database.py creates. TimingMiddleware reports them on the response as a
+Server-Timing header and adds them to per-route histograms, served in the
+Prometheus text format at /metrics.
+
+Everything is a few perf_counter calls and additions per statement, cheap
+enough to stay on. Set METRICS=0 to leave the middleware out.
+"""
+from contextvars import ContextVar
+from typing import Optional
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+import threading
+import time
+
+# seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class RequestStats:
+    __slots__ = ("request", "queries", "db_time", "pool_wait", "render_time")
+
+    def __init__(self, request: str = None):
+        self.request = request
+        self.queries = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.render_time = 0.0
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_request() -> Optional[str]:
+    """
+    Method, path and query string of the request being served, if any.
+    """
+    stats = _current.get()
+    return stats.request if stats is not None else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None:
+        starts = conn.info.get("query_start")
+        if starts:
+            stats.db_time += time.perf_counter() - starts.pop()
+        stats.queries += 1
+
+
+def _handle_error(context):
+    # a failed statement never gets its after_cursor_execute
+    starts = context.connection.info.get("query_start") if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def instrument(engine):
+    """
+    Counts and times the statements of engine (a sync Engine, pass
+    async_engine.sync_engine for an AsyncEngine) into the current request.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def record_pool_wait(seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+
+class TimedJSONResponse(JSONResponse):
+    """
+    The default response class, times the json encoding of the body.
+    """
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        stats = _current.get()
+        if stats is not None:
+            stats.render_time += time.perf_counter() - start
+        return body
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count per label set, the way Prometheus
+    histograms are exposed.
+    """
+
+    def __init__(self, name: str, help: str, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self, label_names: tuple) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self._series.items())
+        for labels, (counts, total, count) in series:
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(label_names, labels))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+LABELS = ("method", "route", "status")
+
+request_duration = Histogram("http_request_duration_seconds", "Time from request to response start.", TIME_BUCKETS)
+request_queries = Histogram("http_request_db_queries", "SQL statements run per request.", QUERY_BUCKETS)
+request_db_time = Histogram("http_request_db_seconds", "Time spent executing SQL per request.", TIME_BUCKETS)
+request_pool_wait = Histogram("http_request_pool_wait_seconds", "Time spent waiting for a pool connection per request.", TIME_BUCKETS)
+request_render_time = Histogram("http_request_render_seconds", "Time spent encoding the response body per request.", TIME_BUCKETS)
+
+HISTOGRAMS = (request_duration, request_queries, request_db_time, request_pool_wait, request_render_time)
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render(LABELS))
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(stats: RequestStats, total: float) -> str:
+    return (
+        f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries", '
+        f"pool;dur={stats.pool_wait * 1000:.2f}, "
+        f"render;dur={stats.render_time * 1000:.2f}, "
+        f"total;dur={total * 1000:.2f}"
+    )
+
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware, which costs a task and a
+    stream per request). The stats are final once the response starts, so
+    that's where the header goes in and the histograms get updated.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request = f"{scope['method']} {scope['path']}"
+        if scope.get("query_string"):
+            request += "?" + scope["query_string"].decode("latin-1")
+        stats = RequestStats(request)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        started = False
+
+        async def send_timed(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                total = time.perf_counter() - start
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", server_timing(stats, total).encode("latin-1"))]
+                self._observe(scope, message["status"], stats, total)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            # the 500 is sent further out, by ServerErrorMiddleware
+            if not started:
+                self._observe(scope, 500, stats, time.perf_counter() - start)
+            raise
+        finally:
+            _current.reset(token)
+
+    def _route(self, scope) -> str:
+        # the path template, not the path, so ids don't explode the label set
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self._routes.get(endpoint)
+        if route is None:
+            route = next((r.path for r in scope["app"].routes if getattr(r, "endpoint", None) is endpoint), "unmatched")
+            self._routes[endpoint] = route
+        return route
+
+    def _observe(self, scope, status: int, stats: RequestStats, total: float):
+        labels = (scope["method"], self._route(scope), str(status))
+        request_duration.observe(labels, total)
+        request_queries.observe(labels, stats.queries)
+        request_db_time.observe(labels, stats.db_time)
+        request_pool_wait.observe(labels, stats.pool_wait)
+        request_render_time.observe(labels, stats.render_time)
@@ -0,0 +1,63 @@
+"""
+Applies the versioned sql files in migrations/ that haven't been run against
+the database yet, in file name order. Each file runs in its own transaction
+and is recorded in the schema_migrations table. A file starting with
+`-- dialect: <name>` only runs on that database (e.g. postgresql).
+
+    python -m src.migrate
+"""
+import os
+import sqlalchemy
+from src import database as db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+
+def migration_files():
+    return sorted(f for f in os.listdir(MIGRATIONS_DIR) if f.endswith(".sql"))
+
+
+def migration_dialect(sql: str):
+    first_line = sql.split("\n", 1)[0].strip()
+    if first_line.startswith("-- dialect:"):
+        return first_line[len("-- dialect:"):].strip()
+    return None
+
+
+def migrate(engine=None):
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text("CREATE TABLE IF NOT EXISTS schema_migrations (version text PRIMARY KEY, applied_at timestamp DEFAULT CURRENT_TIMESTAMP)"))
+        applied = {row.version for row in conn.execute(sqlalchemy.text("SELECT version FROM schema_migrations"))}
+
+    ran = []
+    for name in migration_files():
+        if name in applied:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, name), encoding="utf-8") as f:
+            sql = f.read()
+        dialect = migration_dialect(sql)
+        if dialect is not None and dialect != engine.dialect.name:
+            continue
+        with engine.begin() as conn:
+            if engine.dialect.name == "sqlite":
+                # sqlite3 only runs multiple statements through executescript,
+                # which commits whatever is pending first, so the script opens
+                # its own transaction and records the version inside it
+                version = name.replace("'", "''")
+                conn.connection.driver_connection.executescript(
+                    f"BEGIN;\n{sql}\n;\nINSERT INTO schema_migrations (version) VALUES ('{version}');\nCOMMIT;"
+                )
+            else:
+                # straight to the driver without parameters, so psycopg2 leaves
+                # the % of LIKE patterns (and of comments about them) alone
+                conn.connection.cursor().execute(sql)
+                conn.execute(sqlalchemy.text("INSERT INTO schema_migrations (version) VALUES (:version)"), {"version": name})
+        ran.append(name)
+    return ran
+
+
+if __name__ == "__main__":
+    for name in migrate():
+        print(f"applied {name}")
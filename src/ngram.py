@@ -0,0 +1,103 @@
+"""
+Substring search for the name and title filters of the list endpoints.
+
+On Postgres `ILIKE '%fragment%'` is served by the pg_trgm GIN indexes from
+migrations/003_trigram_indexes.sql. Other backends have no such index, so an
+in-process n-gram index over the (small) name/title columns narrows the
+filter down to an id list instead.
+"""
+from array import array
+from collections import defaultdict
+import threading
+import sqlalchemy
+from src import database as db
+
+# a common fragment is cheaper as a scan in sort order, which stops as soon
+# as the page is full: past this many matches the sql filter stays an ILIKE
+MAX_IDS = 250
+# the same for the snapshot engine, as a share of the rows it would walk
+MAX_SELECTIVITY = 0.25
+
+
+class NgramIndex:
+    """
+    Maps every 1..n character substring of the (lowercased) texts to the
+    sorted ids containing it. Fragments up to n characters are a single
+    lookup, longer ones intersect their n-grams and check the candidates.
+    """
+
+    __slots__ = ("n", "texts", "postings")
+
+    def __init__(self, items, n: int = 3):
+        self.n = n
+        self.texts = {}
+        postings = defaultdict(list)
+        for id, text in items:
+            if text is None:
+                continue
+            text = text.lower()
+            self.texts[id] = text
+            grams = {text[i:i + k] for k in range(1, n + 1) for i in range(len(text) - k + 1)}
+            for gram in grams:
+                postings[gram].append(id)
+        self.postings = {gram: array("i", sorted(ids)) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def search(self, fragment: str) -> list:
+        """
+        Sorted ids whose text contains fragment, case insensitive.
+        """
+        fragment = fragment.lower()
+        if len(fragment) <= self.n:
+            return list(self.postings.get(fragment, ()))
+
+        grams = {fragment[i:i + self.n] for i in range(len(fragment) - self.n + 1)}
+        lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+        candidates = set(lists[0])
+        for ids in lists[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(ids)
+        return sorted(id for id in candidates if fragment in self.texts[id])
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def index_for(conn, id_column, column) -> NgramIndex:
+    key = (column.table.name, column.name)
+    if key not in _indexes:
+        with _lock:
+            if key not in _indexes:
+                _indexes[key] = NgramIndex(conn.execute(sqlalchemy.select(id_column, column)))
+    return _indexes[key]
+
+
+def clear():
+    """
+    Drops the in-process indexes, they are rebuilt on next use. Names and
+    titles aren't written by the API, so this is only needed after changing
+    them in the database directly.
+    """
+    with _lock:
+        _indexes.clear()
+
+
+async def contains(id_column, column, fragment: str):
+    """
+    WHERE clause for rows whose column contains fragment, case insensitive,
+    the same rows as column ILIKE '%fragment%'.
+    """
+    like = column.ilike(f"%{fragment}%")
+    # fragments with wildcards keep their LIKE meaning
+    if db.get_engine().dialect.name == "postgresql" or "%" in fragment or "_" in fragment:
+        return like
+
+    index = await db.run(index_for, id_column, column)
+    ids = index.search(fragment)
+    if len(ids) > MAX_IDS:
+        return like
+    return id_column.in_(ids)
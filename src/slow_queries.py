@@ -0,0 +1,167 @@
+"""
+Opt-in slow query log. Statements that take longer than SLOW_QUERY_MS are
+kept, newest last, in a bounded buffer with their SQL as sent to the driver,
+their bind parameters, the request that ran them and their plan, served at
+/slowqueries/.
+
+The plan is taken after the fact on another connection, by a background
+thread, so a slow request doesn't get slower: EXPLAIN (ANALYZE, BUFFERS) for
+SELECTs on Postgres (it runs the query again), a plain EXPLAIN for writes and
+for SELECTs calling a function a rollback doesn't undo (the nextval of
+allocate_ids), EXPLAIN QUERY PLAN on sqlite. Statements from the async engine
+are logged without a plan, its connections can't be used from a plain thread.
+
+Settings:
+    SLOW_QUERY_MS      threshold in milliseconds (0 logs everything), the
+                       log is off without it
+    SLOW_QUERY_BUFFER  how many statements to keep (default 100)
+    SLOW_QUERY_EXPLAIN capture plans (default on)
+"""
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import event
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+# sequence calls aren't rolled back, running them again would burn ids
+NOT_REPEATABLE = re.compile(r"\b(nextval|setval)\s*\(", re.IGNORECASE)
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return str(value)
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float, size: int = 100, explain: bool = True):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        # plans wait here, anything past a buffer's worth is dropped
+        self._pending = queue.Queue(maxsize=size)
+        self._worker = None
+
+    def instrument(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def _handle_error(self, context):
+        starts = context.connection.info.get("slow_query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_start")
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed < self.threshold or statement.lstrip()[:7].upper() == "EXPLAIN":
+            return
+
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "duration_ms": round(elapsed * 1000, 2),
+            "request": metrics.current_request(),
+            "statement": statement,
+            "parameters": _jsonable(parameters),
+            "plan": None,
+        }
+        with self._lock:
+            self.entries.append(entry)
+
+        # executemany has no single plan
+        async_driver = conn.dialect.is_async
+        if self.explain and not executemany and not async_driver:
+            try:
+                self._pending.put_nowait((conn.engine, statement, parameters, entry))
+                self._start_worker()
+            except queue.Full:
+                pass
+
+    def _start_worker(self):
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._explain_loop, name="slow-query-explain", daemon=True)
+                    self._worker.start()
+
+    def _explain_loop(self):
+        while True:
+            engine, statement, parameters, entry = self._pending.get()
+            try:
+                entry["plan"] = explain(engine, statement, parameters)
+            except Exception as e:
+                entry["plan"] = f"explain failed: {e}"
+                logger.debug("explain failed", exc_info=True)
+
+    def recent(self) -> list:
+        with self._lock:
+            return list(reversed(self.entries))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+def explain(engine, statement: str, parameters) -> Optional[str]:
+    keyword = statement.lstrip()[:6].upper()
+    if keyword not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        return None
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            # ANALYZE executes the statement, only do that for reads
+            analyze = keyword == "SELECT" and NOT_REPEATABLE.search(statement) is None
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+            rows = conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+            conn.rollback()
+            return "\n".join(row[0] for row in rows)
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        return "\n".join(row[-1] for row in rows)
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def log() -> Optional[SlowQueryLog]:
+    """
+    The process' slow query log, None when SLOW_QUERY_MS isn't set. Read
+    once, when the first engine is made.
+    """
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                threshold = os.environ.get("SLOW_QUERY_MS", "")
+                if threshold == "":
+                    _log = False
+                else:
+                    # engines are made after database.py finished importing
+                    from src.database import env_flag
+
+                    _log = SlowQueryLog(float(threshold), int(os.environ.get("SLOW_QUERY_BUFFER", "100")), env_flag("SLOW_QUERY_EXPLAIN", True))
+    return _log or None
+
+
+def instrument(engine):
+    slow_log = log()
+    if slow_log is not None:
+        slow_log.instrument(engine)
@@ -0,0 +1,675 @@
+"""
+In-memory read engine, used by the read endpoints when READ_ENGINE=snapshot.
+
+The four tables and their line counts are loaded once into flat columns:
+`array` columns for numbers and row references, interned strings for names
+and titles, and every line text packed into one utf-8 buffer. Rows are
+referenced by position, and the lookups the endpoints need are precomputed as
+offset arrays (lines by conversation in line_sort order, characters by movie,
+conversations by character). A request then only touches the rows it returns.
+
+Settings:
+    READ_ENGINE                sql (default) or snapshot
+    SNAPSHOT_REFRESH_SECONDS   reload from the database every n seconds
+                               (default 0, never)
+
+Conversations added through this worker are applied to its snapshot right
+after they commit. Other workers only see them after their next refresh.
+"""
+from array import array
+from bisect import bisect_left
+import heapq
+from collections import defaultdict
+from starlette.concurrency import run_in_threadpool
+import logging
+import os
+import sys
+import threading
+import time
+import sqlalchemy
+from src import database as db
+from src import ngram
+
+logger = logging.getLogger(__name__)
+
+# stands in for NULL in the integer columns
+NULL_INT = -2**31
+
+LOAD_BATCH = 10000
+
+
+def _to_int(value):
+    return NULL_INT if value is None else value
+
+
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
+def _offsets(counts) -> array:
+    # counts per row -> start offsets, the slice of row r is [start[r], start[r + 1])
+    start = array("i", [0])
+    total = 0
+    for count in counts:
+        total += count
+        start.append(total)
+    return start
+
+
+class IdIndex:
+    """
+    id -> row lookup by binary search over a sorted id column. Rows are only
+    ever appended, so an id arriving out of order just shifts the two arrays.
+    """
+
+    __slots__ = ("ids", "rows")
+
+    def __init__(self):
+        self.ids = array("i")
+        self.rows = array("i")
+
+    def add(self, id: int, row: int):
+        if len(self.ids) == 0 or id > self.ids[-1]:
+            self.ids.append(id)
+            self.rows.append(row)
+        else:
+            i = bisect_left(self.ids, id)
+            self.ids.insert(i, id)
+            self.rows.insert(i, row)
+
+    def find(self, id: int):
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return self.rows[i]
+        return None
+
+
+def _text_ascending(values):
+    # ORDER BY text ASC NULLS LAST, id
+    return (values[0] is None, values[0] or "", *values[1:])
+
+
+def _count_descending(values):
+    # ORDER BY count DESC, id
+    return (-values[0], *values[1:])
+
+
+class SortedView:
+    """
+    The rows of a list endpoint in one of its sort orders, computed once and
+    kept sorted as rows are added or their keys change. A page is a slice, a
+    cursor is found by binary search.
+
+    values(row) gives the sort values of a row as they appear in a cursor
+    (sort key, then id), order(values) turns them into something comparable
+    in the endpoint's order.
+    """
+
+    __slots__ = ("rows", "values", "order")
+
+    def __init__(self, rows, values, order=tuple):
+        self.values = values
+        self.order = order
+        self.rows = array("i", sorted(rows, key=self.key))
+
+    def key(self, row: int):
+        return self.order(self.values(row))
+
+    def position(self, key) -> int:
+        # index of the first row sorting after `key`
+        lo, hi = 0, len(self.rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(self.rows[mid]) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def after(self, values) -> int:
+        return self.position(self.order(values))
+
+    def add(self, row: int):
+        self.rows.insert(self.position(self.key(row)), row)
+
+    def remove(self, row: int, key):
+        # key is the row's key when it was added
+        i = self.position(key) - 1
+        if i >= 0 and self.rows[i] == row:
+            del self.rows[i]
+
+    def page(self, start: int, limit: int, offset: int = 0, end: int = None, match=None) -> list:
+        """
+        `limit` rows from position `start` on, skipping `offset` rows first.
+        With `match` only the rows it accepts count, and the walk stops as soon
+        as the page is full.
+        """
+        rows = self.rows[start:end]
+        if match is None:
+            return list(rows[offset:offset + limit])
+        page = []
+        for row in rows:
+            if match(row):
+                if offset > 0:
+                    offset -= 1
+                    continue
+                page.append(row)
+                if len(page) == limit:
+                    break
+        return page
+
+    def select(self, rows, start: int, limit: int, offset: int = 0) -> list:
+        """
+        The same page as page(start, ..., match=rows.__contains__), for a few
+        candidate rows: sorting them beats walking the view when the filter
+        matches only a small share of it.
+        """
+        if start > 0:
+            bound = self.key(self.rows[start - 1])
+            rows = [row for row in rows if self.key(row) > bound]
+        return heapq.nsmallest(offset + limit, rows, key=self.key)[offset:]
+
+
+class Snapshot:
+    """
+    One immutable-ish copy of the data. Build it with Snapshot.load(conn); the
+    only change it takes afterwards is apply_conversation.
+    """
+
+    __slots__ = (
+        "loaded_at",
+        # movies
+        "movie_ids", "movie_title", "movie_year", "movie_rating", "movie_votes", "movie_index",
+        # characters
+        "character_ids", "character_name", "character_gender", "character_movie", "character_lines", "character_index",
+        "names_sorted", "name_order", "name_search",
+        # conversations
+        "convo_ids", "convo_character1", "convo_character2", "convo_movie",
+        "convo_lines", "convo_character1_lines", "convo_character2_lines", "convo_index",
+        # lines, grouped by conversation row
+        "line_start", "line_character", "text", "text_start",
+        # characters by movie, conversations by character
+        "movie_character_start", "movie_character_rows",
+        "character_convo_start", "character_convo_rows", "extra_character_convos",
+        # list endpoint sort orders
+        "character_views", "convo_views",
+    )
+
+    @classmethod
+    def load(cls, conn) -> "Snapshot":
+        self = cls()
+        self.loaded_at = time.time()
+        self._load_movies(conn)
+        self._load_characters(conn)
+        self._load_conversations(conn)
+        self._load_lines(conn)
+        self._build_indexes()
+        return self
+
+    def _load_movies(self, conn):
+        self.movie_ids = array("i")
+        self.movie_title = []
+        self.movie_year = array("i")
+        self.movie_rating = array("d")
+        self.movie_votes = array("i")
+        self.movie_index = IdIndex()
+
+        movies = db.movies
+        query = sqlalchemy.select(movies.c.movie_id, movies.c.title, movies.c.year, movies.c.imdb_rating, movies.c.imdb_votes).order_by(movies.c.movie_id)
+        for row in conn.execute(query):
+            self.movie_index.add(row.movie_id, len(self.movie_ids))
+            self.movie_ids.append(row.movie_id)
+            self.movie_title.append(_intern(row.title))
+            self.movie_year.append(_to_int(row.year))
+            self.movie_rating.append(float("nan") if row.imdb_rating is None else row.imdb_rating)
+            self.movie_votes.append(_to_int(row.imdb_votes))
+
+    def _load_characters(self, conn):
+        self.character_ids = array("i")
+        self.character_name = []
+        self.character_gender = []
+        self.character_movie = array("i")
+        self.character_lines = array("i")
+        self.character_index = IdIndex()
+
+        characters = db.characters
+        line_counts = db.character_line_counts
+        query = (
+            sqlalchemy.select(characters.c.character_id, characters.c.name, characters.c.gender, characters.c.movie_id, line_counts.c.line_count)
+            .select_from(characters.outerjoin(line_counts, characters.c.character_id == line_counts.c.character_id))
+            .order_by(characters.c.character_id)
+        )
+        for row in conn.execute(query):
+            movie = self.movie_index.find(row.movie_id)
+            if movie is None:
+                continue
+            self.character_index.add(row.character_id, len(self.character_ids))
+            self.character_ids.append(row.character_id)
+            self.character_name.append(_intern(row.name))
+            self.character_gender.append(_intern(row.gender))
+            self.character_movie.append(movie)
+            self.character_lines.append(row.line_count or 0)
+
+    def _load_conversations(self, conn):
+        self.convo_ids = array("i")
+        self.convo_character1 = array("i")
+        self.convo_character2 = array("i")
+        self.convo_movie = array("i")
+        self.convo_lines = array("i")
+        self.convo_character1_lines = array("i")
+        self.convo_character2_lines = array("i")
+        self.convo_index = IdIndex()
+
+        conversations = db.conversations
+        line_counts = db.conversation_line_counts
+        query = (
+            sqlalchemy.select(
+                conversations.c.conversation_id, conversations.c.character1_id, conversations.c.character2_id, conversations.c.movie_id,
+                line_counts.c.line_count, line_counts.c.character1_lines, line_counts.c.character2_lines,
+            )
+            .select_from(conversations.outerjoin(line_counts, conversations.c.conversation_id == line_counts.c.conversation_id))
+            .order_by(conversations.c.conversation_id)
+        )
+        # plain dicts while loading, they are dropped afterwards
+        character_rows = {id: row for row, id in enumerate(self.character_ids)}
+        movie_rows = {id: row for row, id in enumerate(self.movie_ids)}
+        for row in conn.execute(query):
+            c1 = character_rows.get(row.character1_id)
+            c2 = character_rows.get(row.character2_id)
+            movie = movie_rows.get(row.movie_id)
+            if c1 is None or c2 is None or movie is None:
+                continue
+            self.convo_index.add(row.conversation_id, len(self.convo_ids))
+            self.convo_ids.append(row.conversation_id)
+            self.convo_character1.append(c1)
+            self.convo_character2.append(c2)
+            self.convo_movie.append(movie)
+            self.convo_lines.append(row.line_count or 0)
+            self.convo_character1_lines.append(row.character1_lines or 0)
+            self.convo_character2_lines.append(row.character2_lines or 0)
+
+    def _load_lines(self, conn):
+        self.line_character = array("i")
+        self.text = bytearray()
+        self.text_start = array("q", [0])
+
+        # conversation rows are in id order and so are the lines, so the lines
+        # of each conversation come out as one run
+        counts = array("i", [0]) * len(self.convo_ids)
+        lines = db.lines
+        query = (
+            sqlalchemy.select(lines.c.conversation_id, lines.c.character_id, lines.c.line_text)
+            .order_by(lines.c.conversation_id, lines.c.line_sort, lines.c.line_id)
+            .execution_options(stream_results=True, yield_per=LOAD_BATCH)
+        )
+        character_rows = {id: row for row, id in enumerate(self.character_ids)}
+        convo_id = convo = None
+        for row in conn.execute(query):
+            if row.conversation_id != convo_id:
+                convo_id = row.conversation_id
+                convo = self.convo_index.find(convo_id)
+            character = character_rows.get(row.character_id)
+            if convo is None or character is None:
+                continue
+            counts[convo] += 1
+            self.line_character.append(character)
+            self.text += (row.line_text or "").encode("utf-8")
+            self.text_start.append(len(self.text))
+        self.line_start = _offsets(counts)
+
+    def _build_indexes(self):
+        # characters by movie, in character id order
+        movie_counts = array("i", [0]) * len(self.movie_ids)
+        for movie in self.character_movie:
+            movie_counts[movie] += 1
+        self.movie_character_start = _offsets(movie_counts)
+        fill = array("i", self.movie_character_start[:-1])
+        self.movie_character_rows = array("i", [0]) * len(self.character_ids)
+        for character, movie in enumerate(self.character_movie):
+            self.movie_character_rows[fill[movie]] = character
+            fill[movie] += 1
+
+        # conversations by character, in conversation id order
+        character_counts = array("i", [0]) * len(self.character_ids)
+        for c1, c2 in zip(self.convo_character1, self.convo_character2):
+            character_counts[c1] += 1
+            if c2 != c1:
+                character_counts[c2] += 1
+        self.character_convo_start = _offsets(character_counts)
+        fill = array("i", self.character_convo_start[:-1])
+        self.character_convo_rows = array("i", [0]) * self.character_convo_start[-1]
+        for convo, (c1, c2) in enumerate(zip(self.convo_character1, self.convo_character2)):
+            self.character_convo_rows[fill[c1]] = convo
+            fill[c1] += 1
+            if c2 != c1:
+                self.character_convo_rows[fill[c2]] = convo
+                fill[c2] += 1
+        # conversations added after the load, the offset arrays above are fixed
+        self.extra_character_convos = defaultdict(list)
+
+        # character names sorted, for exact name lookups by bisection
+        self.name_order = array("i", sorted(range(len(self.character_ids)), key=lambda r: (self.character_name[r] or "", self.character_ids[r])))
+        self.names_sorted = [self.character_name[r] or "" for r in self.name_order]
+        # substring search for the name filter
+        self.name_search = ngram.NgramIndex(enumerate(self.character_name))
+
+        # one presorted view per sort option of the list endpoints, over the
+        # rows those endpoints return (the ones with lines)
+        characters = [c for c in range(len(self.character_ids)) if self.character_lines[c] > 0]
+        self.character_views = {
+            "character": SortedView(characters, lambda c: [self.character_name[c], self.character_ids[c]], _text_ascending),
+            "movie": SortedView(characters, lambda c: [self.movie_title[self.character_movie[c]], self.character_ids[c]], _text_ascending),
+            "number_of_lines": SortedView(characters, lambda c: [self.character_lines[c], self.character_ids[c]], _count_descending),
+        }
+        convos = [c for c in range(len(self.convo_ids)) if self.convo_lines[c] > 0]
+        self.convo_views = {
+            "conversation_id": SortedView(convos, lambda c: [self.convo_ids[c]]),
+            "title": SortedView(convos, lambda c: [self.movie_title[self.convo_movie[c]], self.convo_ids[c]], _text_ascending),
+            "line_count": SortedView(convos, lambda c: [self.convo_lines[c], self.convo_ids[c]], _count_descending),
+        }
+
+    def character_convos(self, character: int) -> list:
+        rows = list(self.character_convo_rows[self.character_convo_start[character]:self.character_convo_start[character + 1]])
+        extra = self.extra_character_convos.get(character)
+        if extra:
+            rows = sorted(rows + extra, key=lambda r: self.convo_ids[r])
+        return rows
+
+    def line_text(self, line: int) -> str:
+        return self.text[self.text_start[line]:self.text_start[line + 1]].decode("utf-8")
+
+    def get_movie(self, movie_id: int):
+        movie = self.movie_index.find(movie_id)
+        if movie is None:
+            return None
+        characters = [c for c in self.movie_character_rows[self.movie_character_start[movie]:self.movie_character_start[movie + 1]] if self.character_lines[c] > 0]
+        characters.sort(key=lambda c: (-self.character_lines[c], self.character_ids[c]))
+        return {
+            "movie_id": movie_id,
+            "title": self.movie_title[movie],
+            "top_characters": [{
+                "character_id": self.character_ids[c],
+                "character": self.character_name[c],
+                "num_lines": self.character_lines[c]
+            } for c in characters[:5]]
+        }
+
+    def get_character(self, character_id: int, limit: int = None):
+        character = self.character_index.find(character_id)
+        if character is None:
+            return None
+        together = defaultdict(int)
+        for convo in self.character_convos(character):
+            c1 = self.convo_character1[convo]
+            c2 = self.convo_character2[convo]
+            if c1 != c2:
+                together[c2 if c1 == character else c1] += self.convo_lines[convo]
+        others = [c for c, n in together.items() if n > 0]
+        order = lambda c: (-together[c], self.character_ids[c])
+        others = sorted(others, key=order) if limit is None else heapq.nsmallest(limit, others, key=order)
+        return {
+            "character_id": character_id,
+            "character": self.character_name[character],
+            "movie": self.movie_title[self.character_movie[character]],
+            "gender": self.character_gender[character],
+            "top_conversations": [{
+                "character_id": self.character_ids[c],
+                "character": self.character_name[c],
+                "gender": self.character_gender[c],
+                "number_of_lines_together": together[c]
+            } for c in others]
+        }
+
+    def get_lines(self, conversation_id: int):
+        convo = self.convo_index.find(conversation_id)
+        if convo is None:
+            return None
+        return {
+            "conversation_id": conversation_id,
+            "title": self.movie_title[self.convo_movie[convo]],
+            "lines": [{
+                "name": self.character_name[self.line_character[line]],
+                "line_text": self.line_text(line)
+            } for line in range(self.line_start[convo], self.line_start[convo + 1])]
+        }
+
+    def get_character_convos(self, name: str) -> list:
+        jsons = []
+        i = bisect_left(self.names_sorted, name)
+        while i < len(self.names_sorted) and self.names_sorted[i] == name:
+            character = self.name_order[i]
+            conversations = []
+            for convo in self.character_convos(character):
+                first = self.convo_character1[convo] == character
+                conversations.append({
+                    "title": self.movie_title[self.convo_movie[convo]],
+                    "line_count": self.convo_character1_lines[convo] if first else self.convo_character2_lines[convo],
+                    "other_character": self.character_name[self.convo_character2[convo] if first else self.convo_character1[convo]]
+                })
+            jsons.append({
+                "name": name,
+                "character_id": self.character_ids[character],
+                "conversation_count": len(conversations),
+                "conversations": conversations
+            })
+            i += 1
+        return jsons
+
+    def list_characters(self, name: str, sort: str, limit: int, offset: int = 0, after: list = None) -> list:
+        """
+        A page of /characters/: `limit` rows in `sort` order after the cursor
+        values `after`, or after skipping `offset` rows.
+        """
+        view = self.character_views[sort]
+        start = view.after(after) if after is not None else 0
+        if name == "":
+            rows = view.page(start, limit, offset)
+        else:
+            # only the characters in the view, the ones with lines
+            matches = [c for c in self.name_search.search(name) if self.character_lines[c] > 0]
+            if len(matches) <= len(view.rows) * ngram.MAX_SELECTIVITY:
+                rows = view.select(matches, start, limit, offset)
+            else:
+                rows = view.page(start, limit, offset, match=set(matches).__contains__)
+        return [{
+            "character_id": self.character_ids[c],
+            "character": self.character_name[c],
+            "movie": self.movie_title[self.character_movie[c]],
+            "number_of_lines": self.character_lines[c]
+        } for c in rows]
+
+    def list_conversations(self, count: int, sort: str, limit: int, offset: int = 0, after: list = None) -> list:
+        """
+        A page of /lines/conversations/, see list_characters.
+        """
+        view = self.convo_views[sort]
+        start = view.after(after) if after is not None else 0
+        end = None
+        match = None
+        if count is not None:
+            if sort == "line_count":
+                # in line count order the matches are everything up to here
+                end = view.position((-count, float("inf")))
+            else:
+                match = lambda c: self.convo_lines[c] >= count
+        return [{
+            "conversation_id": self.convo_ids[c],
+            "title": self.movie_title[self.convo_movie[c]],
+            "character1": self.character_name[self.convo_character1[c]],
+            "character2": self.character_name[self.convo_character2[c]],
+            "line_count": self.convo_lines[c]
+        } for c in view.page(start, limit, offset, end=end, match=match)]
+
+    def apply_conversation(self, conversation_id: int, movie_id: int, character_1_id: int, character_2_id: int, lines: list):
+        """
+        Adds a committed conversation, lines is a list of (character_id,
+        line_text) in line_sort order. Readers can run alongside: the
+        conversation only becomes visible when its id is indexed, last.
+        """
+        if self.convo_index.find(conversation_id) is not None:
+            return
+        movie = self.movie_index.find(movie_id)
+        c1 = self.character_index.find(character_1_id)
+        c2 = self.character_index.find(character_2_id)
+        if movie is None or c1 is None or c2 is None:
+            return
+
+        # where the two characters sit in the line count order before the update
+        by_lines = self.character_views["number_of_lines"]
+        before = {c: (self.character_lines[c], by_lines.key(c)) for c in (c1, c2)}
+
+        # lines go at the end, which is where the new conversation row's run starts
+        counts = {c1: 0, c2: 0}
+        for character_id, line_text in lines:
+            character = c1 if character_id == character_1_id else c2
+            counts[character] += 1
+            self.line_character.append(character)
+            self.text += line_text.encode("utf-8")
+            self.text_start.append(len(self.text))
+            self.character_lines[character] += 1
+        self.line_start.append(len(self.line_character))
+
+        convo = len(self.convo_ids)
+        self.convo_ids.append(conversation_id)
+        self.convo_character1.append(c1)
+        self.convo_character2.append(c2)
+        self.convo_movie.append(movie)
+        self.convo_lines.append(len(lines))
+        self.convo_character1_lines.append(counts[c1])
+        self.convo_character2_lines.append(counts[c2])
+
+        self.extra_character_convos[c1].append(convo)
+        if c2 != c1:
+            self.extra_character_convos[c2].append(convo)
+
+        for character, (lines_before, key_before) in before.items():
+            if self.character_lines[character] == lines_before:
+                continue
+            if lines_before == 0:
+                # first lines, the character now shows up in the lists
+                for view in self.character_views.values():
+                    view.add(character)
+            else:
+                by_lines.remove(character, key_before)
+                by_lines.add(character)
+        if len(lines) > 0:
+            for view in self.convo_views.values():
+                view.add(convo)
+
+        self.convo_index.add(conversation_id, convo)
+
+    def stats(self) -> dict:
+        arrays = [getattr(self, name) for name in self.__slots__ if isinstance(getattr(self, name, None), array)]
+        arrays += [self.movie_index.ids, self.movie_index.rows, self.character_index.ids, self.character_index.rows, self.convo_index.ids, self.convo_index.rows]
+        strings = set(self.movie_title) | set(self.character_name) | set(self.character_gender)
+        return {
+            "loaded_at": self.loaded_at,
+            "movies": len(self.movie_ids),
+            "characters": len(self.character_ids),
+            "conversations": len(self.convo_ids),
+            "lines": len(self.line_character),
+            "memory_bytes": (
+                sum(a.buffer_info()[1] * a.itemsize for a in arrays)
+                + len(self.text)
+                + sum(sys.getsizeof(l) for l in (self.movie_title, self.character_name, self.character_gender, self.names_sorted))
+                + sum(sys.getsizeof(s) for s in strings if s is not None)
+            ),
+        }
+
+
+_current = None
+_lock = threading.Lock()
+_replay = None        # writes seen while a refresh is loading
+_refresher = None
+
+
+def enabled() -> bool:
+    db.load_env()
+    return os.environ.get("READ_ENGINE", "sql").lower() == "snapshot"
+
+
+def load(engine=None) -> Snapshot:
+    # all the tables are read in one transaction that sees a single point in
+    # time, otherwise a conversation committing halfway through could be in
+    # the conversations but not in the line counts read before them
+    with (engine or db.get_engine()).connect() as conn:
+        db.begin_consistent_read(conn)
+        return Snapshot.load(conn)
+
+
+def current() -> Snapshot:
+    """
+    The snapshot reads are served from, loaded on first use.
+    """
+    global _current
+    if _current is None:
+        with _lock:
+            if _current is None:
+                _current = load()
+                _start_refresher()
+    return _current
+
+
+async def get() -> Snapshot:
+    if _current is not None:
+        return _current
+    return await run_in_threadpool(current)
+
+
+def refresh() -> Snapshot:
+    """
+    Loads a new snapshot from the database and swaps it in. Conversations
+    that commit while it loads are replayed onto it.
+    """
+    global _current, _replay
+    with _lock:
+        _replay = []
+    try:
+        new = load()
+    except Exception:
+        with _lock:
+            _replay = None
+        raise
+    with _lock:
+        for write in _replay:
+            new.apply_conversation(*write)
+        _replay = None
+        _current = new
+    return new
+
+
+def apply_conversation(conversation_id: int, movie_id: int, character_1_id: int, character_2_id: int, lines: list):
+    """
+    Applies a committed conversation to the loaded snapshot, if there is one.
+    """
+    write = (conversation_id, movie_id, character_1_id, character_2_id, lines)
+    with _lock:
+        if _current is not None:
+            _current.apply_conversation(*write)
+        if _replay is not None:
+            _replay.append(write)
+
+
+def stats() -> dict:
+    if _current is None:
+        return {"enabled": enabled(), "loaded": False}
+    return {"enabled": enabled(), "loaded": True, **_current.stats()}
+
+
+def _start_refresher():
+    global _refresher
+    seconds = float(os.environ.get("SNAPSHOT_REFRESH_SECONDS", "0"))
+    if seconds <= 0 or _refresher is not None:
+        return
+
+    def loop():
+        while True:
+            time.sleep(seconds)
+            try:
+                refresh()
+            except Exception:
+                # keep serving the old snapshot, try again next round
+                logger.exception("snapshot refresh failed")
+
+    _refresher = threading.Thread(target=loop, name="snapshot-refresh", daemon=True)
+    _refresher.start()
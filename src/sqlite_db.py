@@ -0,0 +1,135 @@
+"""
+Builds the local SQLite database used with DB_BACKEND=sqlite from the csvs in
+the repo root (movies, characters, conversations) plus a lines file, which
+isn't shipped with the repo. The routers run against it unchanged, so local
+development and CI don't need the remote Postgres.
+
+    python -m src.sqlite_db [--lines lines.csv] [--out local.sqlite3]
+
+Settings:
+    SQLITE_PATH       database file (default local.sqlite3 in the repo root),
+                      built on first use if it doesn't exist
+    SQLITE_LINES_CSV  lines file loaded into it (default lines.csv in the repo
+                      root, the lines table stays empty without one)
+    SQLITE_READ_ONLY  open the file read only, e.g. for a replica
+"""
+import argparse
+import csv
+import os
+import sqlalchemy
+from src import database as db
+from src import migrate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CSV_TABLES = (
+    ("movies", "movies.csv"),
+    ("characters", "characters.csv"),
+    ("conversations", "conversations.csv"),
+)
+
+BATCH_SIZE = 10000
+
+
+def default_path() -> str:
+    return os.environ.get("SQLITE_PATH", os.path.join(ROOT, "local.sqlite3"))
+
+
+def default_lines_csv() -> str:
+    return os.environ.get("SQLITE_LINES_CSV", os.path.join(ROOT, "lines.csv"))
+
+
+def url(path: str, read_only: bool = False) -> str:
+    if read_only:
+        return f"sqlite:///file:{path}?mode=ro&uri=true"
+    return f"sqlite:///{path}"
+
+
+def parse(value: str, python_type):
+    if value == "":
+        return None
+    if python_type is int:
+        # imdb years like 2004/I, the database keeps just the year
+        return int(value.split("/", 1)[0])
+    return python_type(value)
+
+
+def read_csv(path: str, table: sqlalchemy.Table):
+    """
+    Yields the rows of a csv as dicts typed after the table's columns, empty
+    fields become NULL.
+    """
+    types = {c.name: c.type.python_type for c in table.columns}
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            yield {name: parse(value, types[name]) for name, value in row.items() if name in types}
+
+
+def load(conn, table: sqlalchemy.Table, path: str) -> int:
+    batch = []
+    count = 0
+    for row in read_csv(path, table):
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            conn.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if len(batch) > 0:
+        conn.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def build(path: str, lines_csv: str = None) -> dict:
+    """
+    Creates the database at path (replacing it) and returns the number of rows
+    loaded per table. The file is written next to path and moved into place at
+    the end, so a server never sees a half built database.
+    """
+    tmp_path = path + ".building"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    engine = sqlalchemy.create_engine(url(tmp_path))
+    counts = {}
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+            for name, csv_name in CSV_TABLES:
+                counts[name] = load(conn, db.metadata.tables[name], os.path.join(ROOT, csv_name))
+            if lines_csv is not None and os.path.exists(lines_csv):
+                counts["lines"] = load(conn, db.lines, lines_csv)
+
+        # indexes, aggregates and their backfill come from the regular
+        # migrations, run once the rows are in
+        migrate.migrate(engine)
+        with engine.connect() as conn:
+            conn.exec_driver_sql("ANALYZE")
+    finally:
+        engine.dispose()
+
+    os.replace(tmp_path, path)
+    return counts
+
+
+def ensure_built(path: str = None) -> str:
+    path = path or default_path()
+    if not os.path.exists(path):
+        build(path, default_lines_csv())
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", default=default_lines_csv())
+    parser.add_argument("--out", default=default_path())
+    args = parser.parse_args()
+
+    for name, count in build(args.out, args.lines).items():
+        print(f"{name}: {count} rows")
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
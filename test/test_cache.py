@@ -0,0 +1,126 @@
+from src.cache import CacheBackend, SQLiteCache, TTLCache, key, make_cache
+
+import asyncio
+import pytest
+import threading
+import time
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make(request, tmp_path):
+    def make(maxsize, ttl):
+        if request.param == "memory":
+            return TTLCache(maxsize=maxsize, ttl=ttl)
+        return SQLiteCache(str(tmp_path / "cache.sqlite3"), maxsize=maxsize, ttl=ttl)
+    return make
+
+
+def test_key_normalized():
+    assert key("list_movies", name="a", limit=5) == key("list_movies", limit=5, name="a")
+
+
+def test_lru_eviction(make):
+    c = make(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    time.sleep(0.01)
+    assert c.get("a") == 1   # a is now the most recently used
+    c.set("c", 3)
+
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_ttl(make):
+    c = make(maxsize=10, ttl=0.01)
+    c.set("a", 1)
+    time.sleep(0.02)
+
+    assert c.get("a") is None
+    assert c.stats()["expirations"] == 1
+
+
+def test_invalidate_tags(make):
+    c = make(maxsize=10, ttl=60)
+    c.set("movie", 1, tags=["movie:44"])
+    c.set("character", 2, tags=["character:2", "characters"])
+    c.set("other", 3, tags=["character:7"])
+    c.invalidate("movie:44", "characters")
+
+    assert c.get("movie") is None
+    assert c.get("character") is None
+    assert c.get("other") == 3
+    assert c.stats()["invalidations"] == 2
+
+
+# two workers pointing at the same file see each other's writes and invalidations
+def test_sqlite_shared(tmp_path):
+    worker1 = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    worker2 = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+
+    worker1.set("get_movie?movie_id=44", {"movie_id": 44}, tags=["movie:44"])
+    assert worker2.get("get_movie?movie_id=44") == {"movie_id": 44}
+
+    worker2.invalidate("movie:44")
+    assert worker1.get("get_movie?movie_id=44") is None
+
+
+# hits are served from an async handler, they must not write to the file
+def test_sqlite_get_is_read_only(tmp_path):
+    c = SQLiteCache(str(tmp_path / "cache.sqlite3"), maxsize=10, ttl=60)
+    c.set("a", 1)
+    conn = c._conn()
+    before = conn.total_changes
+    assert c.get("a") == 1
+    assert c.get("missing") is None
+    assert conn.total_changes == before
+
+
+# writes wait on the file lock, the async handlers run them off the event loop
+def test_sqlite_async_writes_use_threadpool(tmp_path):
+    c = SQLiteCache(str(tmp_path / "cache.sqlite3"), maxsize=10, ttl=60)
+    threads = []
+    for name in ("set", "invalidate"):
+        write = getattr(c, name)
+        setattr(c, name, lambda *args, write=write, **kwargs: threads.append(threading.get_ident()) or write(*args, **kwargs))
+
+    async def handler():
+        await c.aset("a", 1, tags=["movie:44"])
+        assert c.get("a") == 1
+        await c.ainvalidate("movie:44")
+
+    asyncio.run(handler())
+    assert c.get("a") is None
+    assert len(threads) == 2
+    assert threading.get_ident() not in threads
+
+
+def test_sqlite_clear_forgets_hits(tmp_path):
+    c = SQLiteCache(str(tmp_path / "cache.sqlite3"), maxsize=10, ttl=60)
+    c.set("a", 1)
+    assert c.get("a") == 1
+    c.clear()
+    assert c._used == {}
+    assert c.stats()["size"] == 0
+
+
+# workers serving from their own snapshots don't share responses
+def test_snapshot_cache_per_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("CACHE_BACKEND", "sqlite")
+    monkeypatch.setenv("CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv("READ_ENGINE", "sql")
+    assert isinstance(make_cache(), SQLiteCache)
+
+    monkeypatch.setenv("READ_ENGINE", "snapshot")
+    assert isinstance(make_cache(), TTLCache)
+
+
+def test_incomplete_backend():
+    class Partial(CacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
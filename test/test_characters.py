@@ -1,6 +1,7 @@
 from fastapi.testclient import TestClient
 
 from src.api.server import app
+from src import cache
 
 import json
 
@@ -68,3 +69,28 @@ def test_01():
 def test_404():
     response = client.get("/characters/400")
     assert response.status_code == 404
+
+# cursor paging should line up with offset paging
+def test_cursor():
+    first = client.get("/characters/?limit=250&sort=number_of_lines")
+    assert first.status_code == 200
+
+    response = client.get(f"/characters/?limit=250&sort=number_of_lines&cursor={first.headers['X-Next-Cursor']}")
+    assert response.status_code == 200
+    assert response.json() == client.get("/characters/?limit=250&offset=250&sort=number_of_lines").json()
+
+
+def test_get_character_limit():
+    full = client.get("/characters/2").json()
+    response = client.get("/characters/2?limit=2")
+    assert response.status_code == 200
+    assert response.json() == dict(full, top_conversations=full["top_conversations"][:2])
+
+    assert client.get("/characters/2?limit=0").status_code == 422
+
+
+def test_get_character_one_statement():
+    cache.response_cache.clear()
+    response = client.get("/characters/7421")
+    assert response.status_code == 200
+    assert 'desc="1 queries"' in response.headers["Server-Timing"]
@@ -1,12 +1,44 @@
 from fastapi.testclient import TestClient
 
 from src.api.server import app
+from src import database as db
+from src import cache
+from src import snapshot
+from src import sqlite_db
+from sqlalchemy import bindparam, text
+from concurrent.futures import ThreadPoolExecutor
 
 import json
+import pytest
+import sqlalchemy
 
 client = TestClient(app)
 
 
+# the tests that add conversations write to a throwaway sqlite database built
+# from the bundled csvs, never to the one the other tests read
+@pytest.fixture
+def scratch_db(tmp_path, monkeypatch):
+  lines_csv = tmp_path / "lines.csv"
+  lines_csv.write_text(
+    "line_id,character_id,movie_id,conversation_id,line_sort,line_text\n"
+    "0,0,0,0,0,hello\n"
+    "1,2,0,0,1,hi\n"
+  )
+  path = str(tmp_path / "scratch.sqlite3")
+  sqlite_db.build(path, str(lines_csv))
+
+  # on the module dict, so the real engines aren't created just to be replaced
+  engine = sqlalchemy.create_engine(sqlite_db.url(path), future=True)
+  monkeypatch.setitem(vars(db), "engine", engine)
+  monkeypatch.setitem(vars(db), "pool_stats", db.PoolStats(engine))
+  # nor through the async engine, nor into the loaded snapshot
+  monkeypatch.setitem(vars(db), "async_engine", None)
+  monkeypatch.setattr(snapshot, "_current", None)
+  yield engine
+  engine.dispose()
+
+
 """
 json boiler plate 
 
@@ -176,5 +208,122 @@ def test_add_conversations05():
       assert response.json() == json.load(f)
 
 
+# many POSTs at once should never hand out the same conversation or line id
+def test_add_conversations_concurrent(scratch_db):
+  testJson = {
+              "character_1_id": 0,
+              "character_2_id": 2,
+              "lines": [
+                  {
+                  "character_id": 0,
+                  "line_text": "concurrent"
+                  },
+                  {
+                  "character_id": 2,
+                  "line_text": "concurrent"
+                  }
+              ]
+          }
+
+  def post(_):
+    return client.post("/movies/0/conversations/", json = testJson)
+
+  with ThreadPoolExecutor(max_workers=16) as pool:
+    responses = list(pool.map(post, range(64)))
+
+  ids = [response.json() for response in responses if response.status_code == 200]
+  assert len(ids) == 64
+  assert len(set(ids)) == len(ids)
+
+  with scratch_db.connect() as conn:
+    line_ids = conn.execute(text("SELECT line_id FROM lines WHERE conversation_id IN :ids").bindparams(bindparam("ids", expanding=True)), {"ids": ids}).scalars().all()
+  assert len(line_ids) == 2 * len(ids)
+  assert len(set(line_ids)) == len(line_ids)
+
+
+# every rejected conversation of a bulk request is reported with its index
+def test_add_conversations_bulk_errors():
+  testJson = [
+              {
+              "movie_id": 100,
+              "character_1_id": 0,
+              "character_2_id": 1,
+              "lines": []
+              },
+              {
+              "movie_id": 371,
+              "character_1_id": 5558,
+              "character_2_id": 5559,
+              "lines": []
+              },
+              {
+              "movie_id": 402,
+              "character_1_id": 6055,
+              "character_2_id": 6055,
+              "lines": []
+              }
+          ]
+
+  response = client.post("/conversations/bulk/", json = testJson)
+  assert response.status_code == 200
+  assert response.json() == [
+      {"index": 0, "status_code": 404, "detail": "movie not found."},
+      {"index": 1, "status_code": 400, "detail": "characters not in movie."},
+      {"index": 2, "status_code": 400, "detail": "characters are the same."},
+  ]
 
 
+# a bulk request has an upper bound on its size
+def test_add_conversations_bulk_too_many():
+  testJson = [{"movie_id": 0, "character_1_id": 0, "character_2_id": 2, "lines": []}] * 251
+
+  response = client.post("/conversations/bulk/", json = testJson)
+  assert response.status_code == 422
+
+
+# a bulk request adds every valid conversation, keeps the counters in step and
+# sweeps the cache once
+def test_add_conversations_bulk(scratch_db, monkeypatch):
+  testJson = [
+      {"movie_id": 0, "character_1_id": 0, "character_2_id": 2, "lines": [
+          {"character_id": 0, "line_text": "bulk one"},
+          {"character_id": 2, "line_text": "bulk two"},
+          {"character_id": 0, "line_text": "bulk three"}]},
+      {"movie_id": 100, "character_1_id": 0, "character_2_id": 2, "lines": []},
+      {"movie_id": 0, "character_1_id": 2, "character_2_id": 0, "lines": [
+          {"character_id": 2, "line_text": "bulk four"}]},
+  ]
+
+  def line_counts():
+    with scratch_db.connect() as conn:
+      characters = dict(conn.execute(text("SELECT character_id, line_count FROM character_line_counts WHERE character_id IN (0, 2)")).fetchall())
+      pair = conn.execute(text("SELECT line_count FROM character_pair_line_counts WHERE character_id = 0 AND other_character_id = 2")).scalar()
+    return characters, pair or 0
+
+  invalidations = []
+  invalidate = cache.response_cache.invalidate
+  monkeypatch.setattr(cache.response_cache, "invalidate", lambda *tags: invalidations.append(tags) or invalidate(*tags))
+
+  characters_before, pair_before = line_counts()
+  response = client.post("/conversations/bulk/", json = testJson)
+  assert response.status_code == 200
+  results = response.json()
+  ids = [result.get("conversation_id") for result in results]
+  assert [result["index"] for result in results] == [0, 1, 2]
+  assert ids[0] is not None and ids[2] is not None and ids[0] != ids[2]
+  assert ids[1] is None and results[1]["status_code"] == 404
+  assert len(invalidations) == 1
+  assert set(invalidations[0]) == {"movie:0", "character:0", "character:2", "characters", "conversations"}
+
+  with scratch_db.connect() as conn:
+    for convo_id, convo in ((ids[0], testJson[0]), (ids[2], testJson[2])):
+      lines = conn.execute(text("SELECT character_id, line_text, line_sort FROM lines WHERE conversation_id = :id ORDER BY line_sort"), {"id": convo_id}).fetchall()
+      assert [(line.character_id, line.line_text) for line in lines] == [(line["character_id"], line["line_text"]) for line in convo["lines"]]
+      assert [line.line_sort for line in lines] == list(range(len(convo["lines"])))
+      counts = conn.execute(text("SELECT line_count, character1_lines, character2_lines FROM conversation_line_counts WHERE conversation_id = :id"), {"id": convo_id}).one()
+      assert counts.line_count == len(convo["lines"])
+
+  characters_after, pair_after = line_counts()
+  assert characters_after[0] - characters_before[0] == 2
+  assert characters_after[2] - characters_before[2] == 2
+  assert pair_after - pair_before == 4
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+from fastapi.testclient import TestClient
+from sqlalchemy.pool import NullPool
+
+from src.api.server import app
+from src import database as db
+from src import cache
+
+client = TestClient(app)
+
+
+def test_engine_options_defaults(monkeypatch):
+    for name in ("DB_ECHO", "DB_NULLPOOL", "DB_POOL_SIZE", "DB_STATEMENT_TIMEOUT_MS", "VERCEL"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("DB_BACKEND", "postgres")
+    options = db.engine_options()
+
+    assert options["echo"] is False
+    assert options["pool_pre_ping"] is True
+    assert options["pool_size"] == 5
+    assert "connect_args" not in options
+
+
+def test_engine_options_serverless(monkeypatch):
+    monkeypatch.delenv("DB_NULLPOOL", raising=False)
+    monkeypatch.setenv("DB_BACKEND", "postgres")
+    monkeypatch.setenv("VERCEL", "1")
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "5000")
+    options = db.engine_options()
+
+    assert options["poolclass"] is NullPool
+    assert "pool_size" not in options
+    assert options["connect_args"] == {"options": "-c statement_timeout=5000"}
+    assert db.engine_options(async_mode=True)["connect_args"] == {"server_settings": {"statement_timeout": "5000"}}
+
+
+def test_pool_stats():
+    cache.response_cache.clear()
+    before = client.get("/pool/stats/").json()["engine"]
+    assert client.get("/movies/44").status_code == 200
+    after = client.get("/pool/stats/").json()["engine"]
+
+    assert after["checkouts"] > before["checkouts"]
+    assert after["wait_max_ms"] >= 0
+
+
+# a cold start shouldn't connect or load anything only a request needs
+def test_lazy_startup():
+    code = (
+        "import sys, src.api.server\n"
+        "from src import database as db\n"
+        "print(sorted(m for m in ('supabase', 'pkg_resources', 'dotenv', 'psycopg2', 'sqlalchemy.ext.asyncio') if m in sys.modules))\n"
+        "print('engine' in vars(db))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+    assert result.stdout.split("\n")[:2] == ["[]", "False"]
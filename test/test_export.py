@@ -0,0 +1,34 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+
+import json
+
+client = TestClient(app)
+
+
+# the csv export has the same layout as the bundled movies.csv
+def test_export_movies_csv():
+    response = client.get("/export/movies?format=csv")
+    assert response.status_code == 200
+
+    with open("movies.csv", encoding="utf-8") as f:
+        expected = f.read().splitlines()
+    exported = response.text.splitlines()
+    assert exported[0] == expected[0]
+    assert len(exported) == len(expected)
+
+
+def test_export_conversations_movie_filter():
+    response = client.get("/export/conversations?movie_id=0")
+    assert response.status_code == 200
+
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) > 0
+    assert all(row["movie_id"] == 0 for row in rows)
+    assert list(rows[0].keys()) == ["conversation_id", "character1_id", "character2_id", "movie_id"]
+
+
+def test_export_unknown_table():
+    response = client.get("/export/scripts")
+    assert response.status_code == 422
@@ -0,0 +1,103 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+from src import cache
+from src import database as db
+from src import snapshot
+from sqlalchemy import event, inspect
+
+import json
+import pytest
+
+client = TestClient(app)
+
+# the hot read paths, each has to be served from the indexes in
+# migrations/006_join_indexes.sql (and the primary keys)
+ENDPOINTS = [
+    "/movies/0",
+    "/characters/0",
+    "/characters/0?limit=3",
+    "/lines/0",
+    "/lines/names/BIANCA",
+    "/characters/?sort=number_of_lines&limit=10",
+    "/lines/conversations/?sort=line_count&limit=10",
+]
+
+# small enough that a scan is the right plan
+SCANNABLE = {"movies"}
+
+
+def endpoint_queries(path):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    cache.response_cache.clear()
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    return statements
+
+
+def full_scans(conn, statement, parameters):
+    """
+    Tables the plan of statement reads in full.
+    """
+    if conn.dialect.name == "postgresql":
+        # on tables this small a hash join over a seq scan can be the cheaper
+        # plan, discourage scans so one only shows up where no index fits
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans, nodes = [], [(plan[0]["Plan"], False)]
+        while nodes:
+            node, limited = nodes.pop()
+            limited = limited or node["Node Type"] == "Limit"
+            # with seq scans off a full read can also be an index scan without
+            # a condition, unless it's a top-n read in index order
+            if node["Node Type"] == "Seq Scan" or (node["Node Type"] in ("Index Scan", "Index Only Scan") and "Index Cond" not in node and not limited):
+                scans.append(node["Relation Name"])
+            nodes.extend((child, limited) for child in node.get("Plans", []))
+        return scans
+
+    # sqlite: "SCAN t" without an index, detail is "SCAN <table> [AS alias]"
+    plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+    aliases = {}
+    for table, alias in _from_items(statement):
+        aliases[alias or table] = table
+    return [aliases.get(row[3].split()[1], row[3].split()[1]) for row in plan if row[3].startswith("SCAN ") and "INDEX" not in row[3] and "PRIMARY KEY" not in row[3]]
+
+
+def _from_items(statement):
+    # (table, alias) for every FROM/JOIN in a statement
+    words = statement.replace("(", " ").replace(")", " ").replace(",", " ").split()
+    for i, word in enumerate(words[:-1]):
+        if word.upper() in ("FROM", "JOIN"):
+            table = words[i + 1]
+            alias = None
+            if i + 3 < len(words) and words[i + 2].upper() == "AS":
+                alias = words[i + 3]
+            yield table, alias
+
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_endpoint_queries_use_indexes(path):
+    if db.get_async_engine() is not None:
+        pytest.skip("queries run on the async engine")
+    if snapshot.enabled():
+        pytest.skip("reads are served from the snapshot")
+    statements = endpoint_queries(path)
+    assert statements
+
+    with db.engine.connect() as conn:
+        # a materialized subquery is scanned once it is built, what it read
+        # shows up in the plan on its own
+        tables = set(inspect(conn).get_table_names()) - SCANNABLE
+        for statement, parameters in statements:
+            scans = [table for table in full_scans(conn, statement, parameters) if table in tables]
+            assert scans == [], statement
@@ -1,8 +1,13 @@
 from fastapi.testclient import TestClient
 
 from src.api.server import app
+from src import cache
+from src import database as db
+from src import snapshot
+from sqlalchemy import event
 
 import json
+import pytest
 
 client = TestClient(app)
 
@@ -61,3 +66,134 @@ def test_lines1():
 
     with open("test/lines/lines-count=0&offset=3547&limit=25&sort=conversation_id.json") as f:
         assert response.json() == json.load(f)
+
+
+def count_queries(url):
+    if db.get_async_engine() is not None:
+        pytest.skip("queries run on the async engine")
+    if snapshot.enabled():
+        pytest.skip("reads are served from the snapshot")
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # a cached response wouldn't run any
+    cache.response_cache.clear()
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return response, len(statements)
+
+# KEN and BIANCA are in many more conversations than FERRARI, the number of
+# queries should not grow with the conversation count
+def test_character_convos_query_count():
+    for name in ["FERRARI", "KEN", "BIANCA"]:
+        response, queries = count_queries(f"/lines/names/{name}")
+        assert response.status_code == 200
+        assert queries == 1
+
+# character names are joined in, a full page is still one statement
+def test_list_conversations_query_count():
+    response, queries = count_queries("/lines/conversations/?limit=250")
+    assert response.status_code == 200
+    assert queries == 1
+
+def test_list_conversations_cursor():
+    first = client.get("/lines/conversations/?count=0&offset=3522&limit=25&sort=conversation_id")
+    assert first.status_code == 200
+
+    response = client.get(f"/lines/conversations/?count=0&limit=25&sort=conversation_id&cursor={first.headers['X-Next-Cursor']}")
+    assert response.status_code == 200
+
+    with open("test/lines/lines-count=0&offset=3547&limit=25&sort=conversation_id.json") as f:
+        assert response.json() == json.load(f)
+
+def test_list_conversations_bounds():
+    assert client.get("/lines/conversations/?limit=0").status_code == 422
+    assert client.get("/lines/conversations/?limit=-1").status_code == 422
+    assert client.get("/lines/conversations/?limit=251").status_code == 422
+    assert client.get("/lines/conversations/?offset=-1").status_code == 422
+
+def test_search_lines_cursor():
+    # not a stop word, postgres' english config would drop "you"
+    response = client.get("/lines/search?query=never&limit=20")
+    assert response.status_code == 200
+    everything = response.json()
+    assert len(everything) == 20
+    assert all("<b>" in line["snippet"] for line in everything)
+    assert [line["rank"] for line in everything] == sorted((line["rank"] for line in everything), reverse=True)
+
+    first = client.get("/lines/search?query=never&limit=10")
+    second = client.get("/lines/search", params={"query": "never", "limit": 10, "cursor": first.headers["X-Next-Cursor"]})
+    assert first.json() + second.json() == everything
+
+def test_search_lines_bounds():
+    assert client.get("/lines/search?query=hello&limit=0").status_code == 422
+    assert client.get("/lines/search?query=hello&limit=-1").status_code == 422
+    assert client.get("/lines/search?query=hello&limit=251").status_code == 422
+    assert client.get("/lines/search?query=hello&limit=250").status_code == 200
+
+def test_search_lines_route():
+    # not taken for a conversation id
+    assert client.get("/lines/search?query=%22%22").json() == []
+
+def test_get_lines_cursor():
+    everything = client.get("/lines/6123").json()
+
+    lines, cursor = [], None
+    while True:
+        response = client.get("/lines/6123", params={"limit": 2, "cursor": cursor} if cursor else {"limit": 2})
+        assert response.status_code == 200
+        assert response.json()["title"] == everything["title"]
+        lines += response.json()["lines"]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert lines == everything["lines"]
+
+def test_get_lines_stream():
+    response = client.get("/lines/6123")
+    streamed = client.get("/lines/6123?stream=true")
+    assert streamed.status_code == 200
+    assert streamed.content == response.content
+
+    first = client.get("/lines/6123?stream=true&limit=2")
+    assert first.json()["lines"] == response.json()["lines"][:2]
+    second = client.get("/lines/6123", params={"stream": True, "cursor": first.headers["X-Next-Cursor"]})
+    assert second.json()["lines"] == response.json()["lines"][2:]
+
+    assert client.get("/lines/99999999?stream=true").status_code == 404
+
+# the head, the next cursor and the lines of a stream are read on one connection
+def test_get_lines_stream_one_connection():
+    if db.get_async_engine() is not None:
+        pytest.skip("queries run on the async engine")
+    connections = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        connections.append(conn)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/lines/6123?stream=true&limit=2")
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    assert len(connections) >= 3
+    assert all(conn is connections[0] for conn in connections)
+
+# pages still line up after the tables were re-reflected
+def test_get_lines_cursor_after_refresh_schema(monkeypatch):
+    for name in db.TABLE_NAMES + ("metadata",):
+        monkeypatch.setitem(vars(db), name, getattr(db, name))
+    response = client.get("/lines/6123")
+    db.refresh_schema()
+
+    for stream in (False, True):
+        first = client.get("/lines/6123", params={"stream": stream, "limit": 2})
+        assert first.json()["lines"] == response.json()["lines"][:2]
+        second = client.get("/lines/6123", params={"stream": stream, "cursor": first.headers["X-Next-Cursor"]})
+        assert second.json()["lines"] == response.json()["lines"][2:]
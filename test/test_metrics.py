@@ -0,0 +1,43 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+from src import cache
+from src import metrics
+
+client = TestClient(app)
+
+
+def test_server_timing():
+    cache.response_cache.clear()
+    response = client.get("/movies/0")
+    assert response.status_code == 200
+
+    timing = dict(part.split(";", 1) for part in response.headers["Server-Timing"].split(", "))
+    assert set(timing) == {"db", "pool", "render", "total"}
+    assert 'desc="2 queries"' in timing["db"]
+
+    # served from the cache, no sql at all
+    assert 'desc="0 queries"' in client.get("/movies/0").headers["Server-Timing"]
+
+
+def test_metrics():
+    client.get("/lines/0")
+    text = client.get("/metrics").text
+
+    # labelled by route template, not by path
+    assert 'http_request_db_queries_count{method="GET",route="/lines/{conversation_id}",status="200"}' in text
+    assert 'route="/lines/0"' not in text
+
+
+def test_histogram():
+    histogram = metrics.Histogram("h", "help", (1, 5))
+    for value in (0, 3, 3, 9):
+        histogram.observe(("a",), value)
+
+    assert histogram.render(("label",))[2:] == [
+        'h_bucket{label="a",le="1"} 1',
+        'h_bucket{label="a",le="5"} 3',
+        'h_bucket{label="a",le="+Inf"} 4',
+        'h_sum{label="a"} 15.0',
+        'h_count{label="a"} 4',
+    ]
@@ -65,3 +65,28 @@ def test_03():
 def test_404():
     response = client.get("/movies/1")
     assert response.status_code == 404
+
+# the cursor from the first page should continue exactly where offset would
+def test_cursor():
+    first = client.get("/movies/?limit=50&sort=rating")
+    assert first.status_code == 200
+
+    response = client.get(f"/movies/?limit=50&sort=rating&cursor={first.headers['X-Next-Cursor']}")
+    assert response.status_code == 200
+    assert response.json() == client.get("/movies/?limit=50&offset=50&sort=rating").json()
+
+def test_bad_cursor():
+    response = client.get("/movies/?cursor=notacursor")
+    assert response.status_code == 400
+
+# well formed but with values that don't fit the sort keys
+def test_tampered_cursor():
+    from src.api import pagination
+
+    for after in ([{"a": 1}, 1], ["Titanic", "1"], [1.5, True], [[1], 1]):
+        cursor = pagination.encode_cursor("rating", after)
+        response = client.get(f"/movies/?sort=rating&cursor={cursor}")
+        assert response.status_code == 400
+
+    cursor = pagination.encode_cursor("rating", [8, 1])
+    assert client.get(f"/movies/?sort=rating&cursor={cursor}").status_code == 200
@@ -0,0 +1,18 @@
+from src.ngram import NgramIndex
+
+
+def test_search():
+    index = NgramIndex([(0, "Batman"), (1, "MANNY"), (2, "Dad"), (3, None), (4, "Ed")])
+
+    assert index.search("d") == [2, 4]
+    assert index.search("man") == [0, 1]
+    assert index.search("tman") == [0]
+    assert index.search("anman") == []
+    assert index.search("x") == []
+    assert len(index) == 4
+
+
+def test_search_long_fragment():
+    # every trigram matches but the fragment doesn't
+    index = NgramIndex([(0, "abcxbcd"), (1, "abcd")])
+    assert index.search("abcd") == [1]
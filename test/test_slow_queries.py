@@ -0,0 +1,69 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+from src import cache
+from src import database as db
+from src import slow_queries
+from sqlalchemy import event
+
+import pytest
+import time
+
+client = TestClient(app)
+
+
+def wait_for_plans(entries):
+    deadline = time.time() + 5
+    while any(e["plan"] is None for e in entries) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_slow_query_log(monkeypatch):
+    # everything counts as slow
+    slow_log = slow_queries.SlowQueryLog(0, size=3)
+    slow_log.instrument(db.engine)
+    monkeypatch.setattr(slow_queries, "_log", slow_log)
+    monkeypatch.setenv("DEBUG_TOKEN", "secret")
+    try:
+        cache.response_cache.clear()
+        assert client.get("/lines/0?unused=1").status_code == 200
+    finally:
+        for name in ("before_cursor_execute", "after_cursor_execute", "handle_error"):
+            event.remove(db.engine, name, getattr(slow_log, "_" + name))
+
+    assert client.get("/slowqueries/").status_code == 403
+    assert client.get("/slowqueries/", headers={"X-Debug-Token": "wrong"}).status_code == 403
+
+    entries = slow_log.recent()
+    assert 0 < len(entries) <= 3
+    wait_for_plans(entries)
+    entry = entries[-1]
+    assert entry["request"] == "GET /lines/0?unused=1"
+    assert "conversations" in entry["statement"]
+    assert entry["plan"]
+
+    response = client.get("/slowqueries/", headers={"X-Debug-Token": "secret"})
+    assert response.status_code == 200
+    assert response.json()["queries"] == entries
+
+
+def test_slow_queries_without_token(monkeypatch):
+    monkeypatch.delenv("DEBUG_TOKEN", raising=False)
+    assert client.get("/slowqueries/").status_code == 404
+
+
+# explaining the id allocation must not hand out ids
+def test_explain_skips_analyze_for_sequences():
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("sequences are postgres only")
+    statement = "SELECT nextval(pg_get_serial_sequence(%(table)s, %(column)s)) FROM generate_series(1, %(n)s)"
+    parameters = {"table": "lines", "column": "line_id", "n": 100}
+    with db.engine.begin() as conn:
+        before = db.allocate_ids(conn, "lines", "line_id", 1)[0]
+
+    plan = slow_queries.explain(db.engine, statement, parameters)
+    assert "actual time" not in plan
+
+    with db.engine.begin() as conn:
+        assert db.allocate_ids(conn, "lines", "line_id", 1)[0] == before + 1
+    assert "actual time" in slow_queries.explain(db.engine, "SELECT 1", {})
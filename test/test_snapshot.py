@@ -0,0 +1,114 @@
+import pytest
+import sqlalchemy
+
+from src import database as db
+from src import snapshot
+from src import sqlite_db
+from src.snapshot import IdIndex, Snapshot
+
+
+@pytest.fixture(scope="module")
+def snap(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("snapshot")
+    lines_csv = tmp_path / "lines.csv"
+    lines_csv.write_text(
+        "line_id,character_id,movie_id,conversation_id,line_sort,line_text\n"
+        "1,2,0,0,1,hi\n"
+        "0,0,0,0,0,hello\n"
+        "2,0,0,0,2,\"well, bye\"\n"
+        "3,0,0,1,0,again\n"
+    )
+    path = str(tmp_path / "local.sqlite3")
+    sqlite_db.build(path, str(lines_csv))
+    return snapshot.load(sqlalchemy.create_engine(sqlite_db.url(path)))
+
+
+def test_id_index():
+    index = IdIndex()
+    for row, id in enumerate([3, 7, 5, 1]):
+        index.add(id, row)
+
+    assert list(index.ids) == [1, 3, 5, 7]
+    assert [index.find(id) for id in (1, 3, 5, 7)] == [3, 0, 2, 1]
+    assert index.find(4) is None
+
+
+def test_get_lines(snap):
+    assert snap.get_lines(0) == {
+        "conversation_id": 0,
+        "title": "10 things i hate about you",
+        "lines": [
+            {"name": "BIANCA", "line_text": "hello"},
+            {"name": "CAMERON", "line_text": "hi"},
+            {"name": "BIANCA", "line_text": "well, bye"},
+        ],
+    }
+    assert snap.get_lines(-1) is None
+
+
+def test_get_movie_and_character(snap):
+    assert snap.get_movie(0)["top_characters"] == [
+        {"character_id": 0, "character": "BIANCA", "num_lines": 3},
+        {"character_id": 2, "character": "CAMERON", "num_lines": 1},
+    ]
+    assert snap.get_character(2)["top_conversations"] == [
+        {"character_id": 0, "character": "BIANCA", "gender": "F", "number_of_lines_together": 4},
+    ]
+
+
+def test_apply_conversation(snap: Snapshot):
+    before = snap.get_character_convos("BIANCA")[0]["conversation_count"]
+    snap.apply_conversation(10**9, 0, 0, 2, [(0, "one"), (2, "two")])
+
+    assert snap.get_lines(10**9)["lines"] == [
+        {"name": "BIANCA", "line_text": "one"},
+        {"name": "CAMERON", "line_text": "two"},
+    ]
+    assert snap.get_movie(0)["top_characters"][0]["num_lines"] == 4
+    assert snap.get_character(2)["top_conversations"][0]["number_of_lines_together"] == 6
+    assert snap.get_character_convos("BIANCA")[0]["conversation_count"] == before + 1
+
+
+def test_sorted_view():
+    values = {0: ["b", 0], 1: [None, 1], 2: ["a", 2], 3: ["b", 3]}
+    view = snapshot.SortedView(values, lambda r: values[r], snapshot._text_ascending)
+    assert list(view.rows) == [2, 0, 3, 1]   # nulls last, ties by id
+    assert view.page(view.after(["b", 0]), 10) == [3, 1]
+
+    values[4] = ["a", 4]
+    view.add(4)
+    assert view.page(0, 2, offset=1) == [4, 0]
+    assert view.page(0, 10, match=lambda r: values[r][0] == "b") == [0, 3]
+    assert view.select([3, 0, 1], 0, 2) == [0, 3]
+    assert view.select([3, 0, 1], view.after(["b", 0]), 10, offset=1) == [1]
+
+
+def test_list_pages(snap):
+    page = snap.list_conversations(None, "line_count", 1)
+    assert page[0]["line_count"] == max(snap.convo_lines)
+    assert snap.list_conversations(10**6, "line_count", 10) == []
+
+    page = snap.list_characters("", "character", 2)
+    rest = snap.list_characters("", "character", 2, after=[page[-1]["character"], page[-1]["character_id"]])
+    assert snap.list_characters("", "character", 4) == page + rest
+    assert all("an" in c["character"].lower() for c in snap.list_characters("an", "number_of_lines", 10))
+
+
+# the tables are read at one point in time, a conversation that commits while
+# the snapshot loads is left out of all of them
+def test_load_is_consistent(tmp_path, monkeypatch):
+    path = str(tmp_path / "local.sqlite3")
+    sqlite_db.build(path)
+    engine = sqlalchemy.create_engine(sqlite_db.url(path))
+
+    load_conversations = Snapshot._load_conversations
+
+    def commit_then_load(self, conn):
+        with engine.begin() as writer:
+            writer.execute(db.conversations.insert(), {"conversation_id": 10**9, "character1_id": 0, "character2_id": 2, "movie_id": 0})
+        load_conversations(self, conn)
+
+    monkeypatch.setattr(Snapshot, "_load_conversations", commit_then_load)
+    snap = snapshot.load(engine)
+    assert snap.convo_index.find(10**9) is None
+    engine.dispose()
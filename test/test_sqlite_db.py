@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+import sqlalchemy
+
+from src import database as db
+from src import migrate
+from src import sqlite_db
+
+
+def build(tmp_path):
+    lines_csv = tmp_path / "lines.csv"
+    lines_csv.write_text(
+        "line_id,character_id,movie_id,conversation_id,line_sort,line_text\n"
+        "0,0,0,0,0,hello\n"
+        "1,2,0,0,1,hi\n"
+        "2,0,0,0,2,\"well, bye\"\n"
+    )
+    path = str(tmp_path / "local.sqlite3")
+    counts = sqlite_db.build(path, str(lines_csv))
+    return path, counts
+
+
+def test_build(tmp_path):
+    path, counts = build(tmp_path)
+    assert counts["lines"] == 3
+    assert counts["movies"] > 0
+
+    engine = sqlalchemy.create_engine(sqlite_db.url(path, read_only=True))
+    with engine.connect() as conn:
+        # migrations ran, the postgres only one was skipped
+        assert conn.execute(sqlalchemy.text("SELECT version FROM schema_migrations")).scalars().all() == ["000_base_schema.sql", "001_line_counts.sql", "005_line_search_sqlite.sql", "006_join_indexes.sql"]
+        assert conn.execute(sqlalchemy.text("SELECT line_count, character1_lines, character2_lines FROM conversation_line_counts WHERE conversation_id = 0")).one() == (3, 2, 1)
+        assert conn.execute(sqlalchemy.text("SELECT line_count FROM character_pair_line_counts WHERE character_id = 2 AND other_character_id = 0")).scalar_one() == 3
+        # years like 2004/I are stored as the year
+        assert conn.execute(sqlalchemy.text("SELECT year FROM movies WHERE movie_id = 307")).scalar_one() == 2004
+
+        plan = conn.execute(sqlalchemy.text("EXPLAIN QUERY PLAN SELECT * FROM lines WHERE conversation_id = 0 ORDER BY line_sort")).fetchall()
+        assert "lines_conversation_id_idx" in str(plan)
+    engine.dispose()
+
+
+def test_allocate_ids(tmp_path):
+    path, _ = build(tmp_path)
+
+    engine = sqlalchemy.create_engine(sqlite_db.url(path))
+    with engine.begin() as conn:
+        top = conn.execute(sqlalchemy.text("SELECT MAX(conversation_id) FROM conversations")).scalar_one()
+        assert db.allocate_ids(conn, "conversations", "conversation_id", 3) == [top + 1, top + 2, top + 3]
+    engine.dispose()
+
+
+def test_line_search(tmp_path):
+    path, _ = build(tmp_path)
+
+    engine = sqlalchemy.create_engine(sqlite_db.url(path))
+    search = sqlalchemy.text("SELECT rowid FROM lines_fts WHERE lines_fts MATCH :query ORDER BY rowid")
+    with engine.begin() as conn:
+        assert conn.execute(search, {"query": "bye"}).scalars().all() == [2]
+
+        # new lines are searchable inside the transaction that adds them
+        conn.execute(db.lines.insert(), {"line_id": 3, "character_id": 0, "movie_id": 0, "conversation_id": 0, "line_sort": 3, "line_text": "saying goodbye, bye"})
+        assert conn.execute(search, {"query": "bye"}).scalars().all() == [2, 3]
+    engine.dispose()
+
+
+# a sqlite migration that fails halfway leaves neither its tables nor its version
+def test_failed_migration(tmp_path, monkeypatch):
+    (tmp_path / "001_broken.sql").write_text("CREATE TABLE half (x integer);\nCREATE TABLE half (x integer);\n")
+    monkeypatch.setattr(migrate, "MIGRATIONS_DIR", str(tmp_path))
+
+    engine = sqlalchemy.create_engine(sqlite_db.url(str(tmp_path / "broken.sqlite3")))
+    with pytest.raises(sqlite3.OperationalError):
+        migrate.migrate(engine)
+    with engine.connect() as conn:
+        assert conn.execute(sqlalchemy.text("SELECT count(*) FROM schema_migrations")).scalar_one() == 0
+        assert conn.execute(sqlalchemy.text("SELECT count(*) FROM sqlite_master WHERE name = 'half'")).scalar_one() == 0
+    engine.dispose()